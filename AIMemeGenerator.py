@@ -1,56 +1,132 @@
 
 version = "1.0.5"
 
-
-import openai
-from stability_sdk import client
-import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation
-from PIL import Image, ImageDraw, ImageFont
-import requests
-import httpx
-
+# The API SDKs and PIL are imported where they are first needed, so importing this module (like app.py does) stays fast,
+# and only the platforms actually used get loaded. Stability's SDK alone pulls in gRPC and protobuf.
 
 
 import warnings
 import re
-from base64 import b64decode
-from pkg_resources import parse_version
+import binascii
 from collections import namedtuple
 import io
 from datetime import datetime
-import glob
 import string
 import os
-import textwrap
 import sys
 import argparse
 import configparser
 import platform
 import shutil
 import traceback
+import threading
+import queue
+import hashlib
+import json
+import time
+import random
+import sqlite3
+import math
+import functools
+import itertools
+import glob
+import atexit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, TimeoutError as FutureTimeoutError
+from collections import deque
+import struct
+import tempfile
+import weakref
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--openaikey", help="OpenAI API key")
+    parser.add_argument("--clipdropkey", help="ClipDrop API key")
+    parser.add_argument("--stabilitykey", help="Stability AI API key")
+    parser.add_argument("--userprompt", help="A meme subject or concept to send to the chat bot. If not specified, the user will be prompted to enter a subject or concept.")
+    parser.add_argument("--memecount", help="The number of memes to create. If using arguments and not specified, the default is 1.")
+    parser.add_argument("--imageplatform", help="The image platform to use. If using arguments and not specified, the default is 'clipdrop'. Possible options: 'openai', 'stability', 'clipdrop', 'auto'")
+    parser.add_argument("--temperature", help="The temperature to use for the chat bot. If using arguments and not specified, the default is 1.0")
+    parser.add_argument("--basicinstructions", help=f"The basic instructions to use for the chat bot. If using arguments and not specified, default will be used.")
+    parser.add_argument("--imagespecialinstructions", help=f"The image special instructions to use for the chat bot. If using arguments and not specified, default will be used")
+
+    parser.add_argument("--pipeline", action='store_true', help="Generate memes through the staged text / image / render pipeline configured in settings.ini.")
+    parser.add_argument("--maxconcurrent", help="The maximum number of memes to generate at the same time. If using arguments and not specified, the value from settings.ini is used (default 1, meaning one after another).")
+
+    parser.add_argument("--logstats", nargs='?', const='', metavar="LOGFILE", help="Print latency percentiles for each stage from the generation log, then exit. Uses log.jsonl in the output folder unless a log file is given.")
+    parser.add_argument("--logplatform", help="Only include memes from this image platform in --logstats.")
+
+    parser.add_argument("--nouserinput", action='store_true', help="Will prevent any user input prompts, and will instead use default values or other arguments.")
+    parser.add_argument("--nofilesave", action='store_true', help="If specified, the meme will not be saved to a file, and only returned as virtual file part of memeResultsDictsList.")
+    
+    return parser
+
+
+created_folders = set()
+
+render_pool = None
+render_pool_workers = 0
+render_pool_lock = threading.Lock()
+
+image_cache = None
+image_cache_lock = threading.Lock()
+caption_cache = None
+caption_cache_lock = threading.Lock()
+api_clients = {}
+api_clients_lock = threading.Lock()
+generation_logs = {}
+generation_logs_lock = threading.Lock()
+meme_stores = {}
+meme_stores_lock = threading.Lock()
+image_request_executor = None
+image_request_executor_lock = threading.Lock()
+image_latency_trackers = {}
+image_latency_trackers_lock = threading.Lock()
+image_routers = {}
+image_routers_lock = threading.Lock()
+async_api_clients = weakref.WeakKeyDictionary()
+async_api_clients_lock = threading.Lock()
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+config_cache = {}
+config_cache_lock = threading.Lock()
+font_index = None
+font_index_lock = threading.Lock()
+
+font_directories = ["/usr/share/fonts", "~/.fonts", "~/.local/share/fonts", "/usr/local/share/fonts"]
+
+# Everything besides the prompt that decides which image a platform returns. It is part of the image cache key.
+image_request_params = {
+    "openai": {"model": "dall-e-3", "size": "1024x1024"},
+    "stability": {"model": "stable-diffusion-xl-1024-v0-9", "size": "1024x1024", "seed": None, "steps": 30, "cfg_scale": 7.0, "sampler": "K_DPMPP_2M"},
+    "clipdrop": {"model": "text-to-image/v1", "size": "1024x1024"},
+}
 
+ApiKeysTupleClass = namedtuple('ApiKeysTupleClass', ['openai_key', 'clipdrop_key', 'stability_key'])
+ConversationPolicyTupleClass = namedtuple('ConversationPolicyTupleClass', ['mode', 'window', 'token_budget'])
+PipelineConfigTupleClass = namedtuple('PipelineConfigTupleClass', ['text_workers', 'image_workers', 'render_workers', 'image_queue_depth', 'render_queue_depth'])
+ImageRouterConfigTupleClass = namedtuple('ImageRouterConfigTupleClass', ['strategy', 'weights', 'max_concurrent', 'cooldown'])
+RateLimitConfigTupleClass = namedtuple('RateLimitConfigTupleClass', ['requests_per_minute', 'tokens_per_minute', 'folder'])
+ImageRetryPolicyTupleClass = namedtuple('ImageRetryPolicyTupleClass', ['timeouts', 'max_retries', 'backoff_base', 'backoff_max', 'hedge', 'hedge_percentile'])
 
+default_pipeline_config = PipelineConfigTupleClass(text_workers=2, image_workers=4, render_workers=2, image_queue_depth=4, render_queue_depth=4)
+default_conversation_policy = ConversationPolicyTupleClass(mode="sliding_window", window=4, token_budget=2000)
+default_image_retry_policy = ImageRetryPolicyTupleClass(timeouts={"openai": 120, "stability": 120, "clipdrop": 60}, max_retries=3, backoff_base=1.0, backoff_max=30, hedge=False, hedge_percentile=95)
+default_image_router_config = ImageRouterConfigTupleClass(strategy="weighted_round_robin", weights={}, max_concurrent={}, cooldown=30)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("--openaikey", help="OpenAI API key")
-parser.add_argument("--clipdropkey", help="ClipDrop API key")
-parser.add_argument("--stabilitykey", help="Stability AI API key")
-parser.add_argument("--userprompt", help="A meme subject or concept to send to the chat bot. If not specified, the user will be prompted to enter a subject or concept.")
-parser.add_argument("--memecount", help="The number of memes to create. If using arguments and not specified, the default is 1.")
-parser.add_argument("--imageplatform", help="The image platform to use. If using arguments and not specified, the default is 'clipdrop'. Possible options: 'openai', 'stability', 'clipdrop'")
-parser.add_argument("--temperature", help="The temperature to use for the chat bot. If using arguments and not specified, the default is 1.0")
-parser.add_argument("--basicinstructions", help=f"The basic instructions to use for the chat bot. If using arguments and not specified, default will be used.")
-parser.add_argument("--imagespecialinstructions", help=f"The image special instructions to use for the chat bot. If using arguments and not specified, default will be used")
-
-parser.add_argument("--nouserinput", action='store_true', help="Will prevent any user input prompts, and will instead use default values or other arguments.")
-parser.add_argument("--nofilesave", action='store_true', help="If specified, the meme will not be saved to a file, and only returned as virtual file part of memeResultsDictsList.")
-args = parser.parse_args()
-
-
-ApiKeysTupleClass = namedtuple('ApiKeysTupleClass', ['openai_key', 'clipdrop_key', 'stability_key'])
 
+class MemeGenerationError(Exception):
+    # Base of every error generate(headless=True) and agenerate() raise, so library callers have one type to catch
+    pass
 
-class NoFontFileError(Exception):
+class NoFontFileError(MemeGenerationError):
     def __init__(self, message, font_file):
         full_error_message = f'Font file "{font_file}" not found. Please add the font file to the same folder as this script. Or set the variable above to the name of a font file in the system font folder.'
         
@@ -58,14 +134,14 @@ class NoFontFileError(Exception):
         self.font_file = font_file
         self.simple_message = message
         
-class MissingOpenAIKeyError(Exception):
+class MissingOpenAIKeyError(MemeGenerationError):
     def __init__(self, message):
         full_error_message = f"No OpenAI API key found. OpenAI API key is required - In order to generate text for the meme text and image prompt. Please add your OpenAI API key to the api_keys.ini file."
         
         super().__init__(full_error_message)
         self.simple_message = message    
         
-class MissingAPIKeyError(Exception):
+class MissingAPIKeyError(MemeGenerationError):
     def __init__(self, message, api_platform):
         full_error_message = f"{api_platform} was set as the image platform, but no {api_platform} API key was found in the api_keys.ini file."
         
@@ -73,7 +149,7 @@ class MissingAPIKeyError(Exception):
         self.api_platform = api_platform
         self.simple_message = message
 
-class InvalidImagePlatformError(Exception):
+class InvalidImagePlatformError(MemeGenerationError):
     def __init__(self, message, given_platform, valid_platforms):
         full_error_message = f"Invalid image platform '{given_platform}'. Valid image platforms are: {valid_platforms}"
         
@@ -82,6 +158,83 @@ class InvalidImagePlatformError(Exception):
         self.valid_platforms = valid_platforms
         self.simple_message = message
 
+class NoImagePlatformError(InvalidImagePlatformError):
+    def __init__(self, message, platforms):
+        full_error_message = f"Image_Platform is set to 'auto', but none of the platforms with an API key ({', '.join(platforms)}) has a weight above 0 in Image_Platform_Weights."
+        
+        # Skips InvalidImagePlatformError's own message, which would call 'auto' invalid
+        super(InvalidImagePlatformError, self).__init__(full_error_message)
+        self.given_platform = "auto"
+        self.valid_platforms = platforms
+        self.simple_message = message
+
+class ImageRequestTimeoutError(MemeGenerationError):
+    def __init__(self, message, platform, timeout):
+        full_error_message = f"The {platform} image request did not finish within {timeout} seconds."
+        
+        super().__init__(full_error_message)
+        self.platform = platform
+        self.timeout = timeout
+        self.simple_message = message
+
+class ModelNotFoundError(MemeGenerationError):
+    def __init__(self, message, text_model):
+        full_error_message = f"The text model '{text_model}' does not exist, or your OpenAI account does not have access to it. Error: {message}"
+        
+        super().__init__(full_error_message)
+        self.text_model = text_model
+        self.simple_message = message
+
+class APIAuthenticationError(MemeGenerationError):
+    def __init__(self, message):
+        full_error_message = f"An API rejected the API key, or the account has no access to what was asked for. Check the keys in the api_keys.ini file. Error: {message}"
+        
+        super().__init__(full_error_message)
+        self.simple_message = message
+
+class APIRateLimitError(MemeGenerationError):
+    def __init__(self, message, retry_after=None):
+        full_error_message = f"An API rate limit or quota was reached. Error: {message}"
+        
+        super().__init__(full_error_message)
+        # Seconds the API asked to wait before trying again, when it said
+        self.retry_after = retry_after
+        self.simple_message = message
+
+class MemeBatchError(MemeGenerationError):
+    def __init__(self, message, errors):
+        firstError = errors[min(errors)]
+        full_error_message = f"All {len(errors)} memes failed. First error: {str(firstError) or type(firstError).__name__}"
+        
+        super().__init__(full_error_message)
+        self.errors = errors
+        self.simple_message = message
+
+
+class MemeResultsList(list):
+    # The memes that were made, in order, plus the errors of the ones that were skipped: {meme index: MemeGenerationError}
+    def __init__(self, memeResults=(), errors=None):
+        super().__init__(memeResults)
+        self.errors = errors or {}
+
+
+def to_meme_generation_error(ex, text_model):
+    # Wraps any other error in the matching MemeGenerationError, keeping the original as __cause__
+    if isinstance(ex, MemeGenerationError):
+        return ex
+    if is_module_error(ex, "openai", "NotFoundError"):
+        error = ModelNotFoundError(str(ex), text_model)
+    # A bad key won't work on a retry, a rate limit will once it has passed, so callers get to tell the two apart
+    elif is_authentication_error(ex):
+        error = APIAuthenticationError(str(ex) or type(ex).__name__)
+    elif is_module_error(ex, "openai", "RateLimitError") or get_error_status_code(ex) == 429 or get_grpc_status_name(ex) == "RESOURCE_EXHAUSTED":
+        error = APIRateLimitError(str(ex) or type(ex).__name__, get_retry_after(ex))
+    else:
+        error = MemeGenerationError(str(ex) or type(ex).__name__)
+    error.__cause__ = ex
+    
+    return error
+
 
 
 
@@ -104,18 +257,7 @@ def check_font(font_file):
             font_file = os.path.join(os.environ['WINDIR'], 'Fonts', font_file)
         elif platform.system() == "Linux":
             
-            font_directories = ["/usr/share/fonts", "~/.fonts", "~/.local/share/fonts", "/usr/local/share/fonts"]
-            found = False
-            for dir in font_directories:
-                dir = os.path.expanduser(dir)
-                for root, dirs, files in os.walk(dir):
-                    if font_file in files:
-                        font_file = os.path.join(root, font_file)
-                        found = True
-                        break
-      
-                if found:
-                    break
+            font_file = find_system_font(font_file) or font_file
 
         
         if not os.path.isfile(font_file):
@@ -124,6 +266,55 @@ def check_font(font_file):
     
     return font_file
 
+def get_font_index_path():
+    cacheFolder = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cacheFolder, "ai_meme_generator", "font_index.json")
+
+
+def build_font_index():
+    # Walks the font folders once, in the same order a search would, so the first font found with a name is the one kept
+    index = {}
+    for directory in font_directories:
+        for root, dirs, files in os.walk(os.path.expanduser(directory)):
+            for file in files:
+                index.setdefault(file, os.path.join(root, file))
+    
+    indexPath = get_font_index_path()
+    try:
+        os.makedirs(os.path.dirname(indexPath), exist_ok=True)
+        with open(indexPath + ".tmp", "w", encoding="utf-8") as indexFile:
+            json.dump(index, indexFile)
+        os.replace(indexPath + ".tmp", indexPath)
+    except OSError:
+        pass
+    
+    return index
+
+
+def load_font_index():
+    try:
+        with open(get_font_index_path(), encoding="utf-8") as indexFile:
+            return json.load(indexFile)
+    except (OSError, ValueError):
+        return None
+
+
+def find_system_font(font_file):
+    global font_index
+    
+    # The index is kept on disk, so walking the font folders only happens when a font isn't where the index last saw it
+    with font_index_lock:
+        if font_index is None:
+            font_index = load_font_index()
+        
+        path = font_index.get(font_file) if font_index else None
+        if path is None or not os.path.isfile(path):
+            font_index = build_font_index()
+            path = font_index.get(font_file)
+    
+    return path
+
+
 def parseBool(string, silent=False):
     if type(string) == str:
         if string.lower() == 'true':
@@ -163,26 +354,40 @@ def get_config(config_file_path):
 
     return config
 
+def get_cached_config(config_file_path):
+    # Parsed once and reused until the file changes. Raises FileNotFoundError for a missing file.
+    fileStat = os.stat(config_file_path)
+    cacheKey = os.path.abspath(config_file_path)
+    signature = (fileStat.st_mtime_ns, fileStat.st_size)
+    
+    with config_cache_lock:
+        cached = config_cache.get(cacheKey)
+        if cached is None or cached[0] != signature:
+            cached = config_cache[cacheKey] = (signature, get_config(config_file_path))
+    
+    # A copy, so a caller changing its settings can't change them for everyone else
+    return dict(cached[1])
+
 def get_assets_file(fileName):
     if hasattr(sys, '_MEIPASS'):
         return os.path.join(sys._MEIPASS, fileName)
     return os.path.join(os.path.abspath("assets"), fileName) 
 
 
-def get_settings(settings_filename="settings.ini"):
+def get_settings(settings_filename="settings.ini", headless=False):
     default_settings_filename = "settings_default.ini"
     def check_settings_file():
         if not os.path.isfile(settings_filename):
             file_to_copy_path = get_assets_file(default_settings_filename)
             shutil.copyfile(file_to_copy_path, settings_filename)
             print("\nINFO: Settings file not found, so default 'settings.ini' file created. You can use it going forward to change more advanced settings if you want.")
-            input("\nPress Enter to continue...")
+            if not headless:
+                input("\nPress Enter to continue...")
     
     check_settings_file()
     
     try:
-        settings = get_config(settings_filename)
-        pass
+        settings = get_cached_config(settings_filename)
     except:
         settings = get_config(get_assets_file(default_settings_filename))
         print("\nERROR: Could not read settings file. Using default settings instead.")
@@ -195,7 +400,7 @@ def get_settings(settings_filename="settings.ini"):
     return settings
 
 
-def get_api_keys(api_key_filename="api_keys.ini", args=None):
+def get_api_keys(api_key_filename="api_keys.ini", args=None, headless=False):
     default_api_key_filename = "api_keys_empty.ini"
     
     
@@ -205,6 +410,8 @@ def get_api_keys(api_key_filename="api_keys.ini", args=None):
             
             shutil.copyfile(file_to_copy_path, api_key_filename)
             print(f'\n  INFO:  Because running for the first time, "{api_key_filename}" was created. Please add your API keys to the API Keys file.')
+            if headless:
+                raise MissingOpenAIKeyError(f'"{api_key_filename}" was just created and has no keys yet.')
             input("\nPress Enter to exit...")
             sys.exit()
 
@@ -216,7 +423,7 @@ def get_api_keys(api_key_filename="api_keys.ini", args=None):
 
    
     try:
-        keys_dict = get_config(api_key_filename)
+        keys_dict = get_cached_config(api_key_filename)
         openai_key = keys_dict.get('OpenAI', '')
         clipdrop_key = keys_dict.get('ClipDrop', '')
         stability_key = keys_dict.get('StabilityAI', '')
@@ -236,10 +443,13 @@ def validate_api_keys(apiKeys, image_platform):
     if not apiKeys.openai_key:
         raise MissingOpenAIKeyError("No OpenAI API key found.")
 
-    valid_image_platforms = ["openai", "stability", "clipdrop"]
+    valid_image_platforms = ["openai", "stability", "clipdrop", "auto"]
     image_platform = image_platform.lower()
 
-    if image_platform in valid_image_platforms:
+    # auto spreads the images over every platform that has a key, and OpenAI always has one
+    if image_platform == "auto":
+        pass
+    elif image_platform in valid_image_platforms:
         if image_platform == "stability" and not apiKeys.stability_key:
             raise MissingAPIKeyError("No Stability AI API key found.", "Stability AI")
 
@@ -249,16 +459,21 @@ def validate_api_keys(apiKeys, image_platform):
     else:
         raise InvalidImagePlatformError(f'Invalid image platform provided.', image_platform, valid_image_platforms)
 
-def initialize_api_clients(apiKeys, image_platform):
+def initialize_api_clients(apiKeys, image_platform, max_connections=20):
     if apiKeys.openai_key:
-        openai_api = openai.OpenAI(api_key=apiKeys.openai_key, http_client=httpx.Client())
+        import httpx
+        import openai
+        # Idle connections are kept open, so later requests through this client skip the TCP and TLS handshakes
+        http_client = httpx.Client(limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections))
+        openai_api = openai.OpenAI(api_key=apiKeys.openai_key, http_client=http_client)
 
 
-    if apiKeys.stability_key and image_platform == "stability":
+    if apiKeys.stability_key and image_platform in ("stability", "auto"):
+        from stability_sdk import client
         stability_api = client.StabilityInference(
             key=apiKeys.stability_key,
             verbose=True, 
-            engine="stable-diffusion-xl-1024-v0-9", 
+            engine=image_request_params["stability"]["model"], 
             )
     else:
         stability_api = None
@@ -267,55 +482,535 @@ def initialize_api_clients(apiKeys, image_platform):
     return stability_api, openai_api
 
 
+def create_clipdrop_session(max_connections=20):
+    import requests
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_connections))
+    
+    return session
+
+
+def get_api_clients(apiKeys, image_platform, max_connections=20):
+    registryKey = (apiKeys, image_platform, max_connections)
+    
+    # Clients are created once per process and shared by every later call, along with their open connections
+    with api_clients_lock:
+        if registryKey not in api_clients:
+            stability_api, openai_api = initialize_api_clients(apiKeys, image_platform, max_connections)
+            clipdrop_session = create_clipdrop_session(max_connections) if apiKeys.clipdrop_key else None
+            api_clients[registryKey] = (stability_api, openai_api, clipdrop_session)
+    
+    return api_clients[registryKey]
+
+
+def get_async_api_clients(apiKeys, max_connections=20):
+    import asyncio
+    import httpx
+    import openai
+    
+    # Async clients belong to the event loop they were first used on, so each loop gets its own
+    loop = asyncio.get_running_loop()
+    registryKey = (apiKeys, max_connections)
+    with async_api_clients_lock:
+        loopClients = async_api_clients.setdefault(loop, {})
+        if registryKey not in loopClients:
+            limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+            async_openai = openai.AsyncOpenAI(api_key=apiKeys.openai_key, http_client=httpx.AsyncClient(limits=limits))
+            clipdrop_client = httpx.AsyncClient(limits=limits) if apiKeys.clipdrop_key else None
+            loopClients[registryKey] = (async_openai, clipdrop_client)
+    
+    return loopClients[registryKey]
+
+
+
+def reset_file_name_allocator():
+    global file_name_counter, file_name_token
+    
+    # A random token per process keeps names unique across workers, and across machines sharing the output folder
+    file_name_counter = itertools.count(1)
+    file_name_token = os.urandom(3).hex()
+
+reset_file_name_allocator()
+if hasattr(os, "register_at_fork"):
+    # Forked workers (gunicorn, the render pool) would otherwise inherit the parent's token and counter
+    os.register_at_fork(after_in_child=reset_file_name_allocator)
+
+
+def get_shard_folder(outputFolder, fileName, sharding="none"):
+    # Spreads the memes over many small folders, so no single folder grows without limit
+    if sharding == "date":
+        return os.path.join(outputFolder, *datetime.now().strftime("%Y %m %d").split())
+    if sharding == "hash":
+        nameHash = hashlib.sha1(fileName.encode('utf-8')).hexdigest()
+        return os.path.join(outputFolder, nameHash[:2], nameHash[2:4])
+    
+    return outputFolder
+
+
+def get_output_sharding(sharding, useMemeIndex):
+    # Only the meme index records which subfolder a meme went into, so without it every meme goes straight into the output folder, where the web app can find it
+    return sharding if useMemeIndex else "none"
+
+
+def set_file_path(baseName, outputFolder, extension="png", sharding="none"):
+    timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M")
+    
+    
+    # next() on itertools.count is atomic, so threads never get the same counter and no lock or folder scan is needed
+    file_counter = next(file_name_counter)
+
+    
+    fileName = baseName + "_" + timestamp + "_" + str(file_counter) + "-" + file_name_token + "." + extension
+    fileFolder = get_shard_folder(outputFolder, fileName, sharding)
+    
+    # Remembered by absolute path, so a relative output folder is made again after the working folder changes
+    folderKey = os.path.abspath(fileFolder)
+    if folderKey not in created_folders:
+        os.makedirs(fileFolder, exist_ok=True)
+        created_folders.add(folderKey)
+    
+    filePath = os.path.join(fileFolder, fileName)
+    
+    return filePath, fileName
+
 
-def set_file_path(baseName, outputFolder):
-    def get_next_counter():
+# Names made by set_file_path(): 'meme_2024-01-31-12-00_1-a1b2c3.png', or 'meme_2024-01-31-12-00_1.png' from before the token was added
+meme_file_name_pattern = re.compile(r"[\w.-]+_\d{4}-\d{2}-\d{2}-\d{2}-\d{2}_\d+(-[0-9a-f]+)?\.(png|jpg|webp)")
+
+def is_meme_file_name(fileName):
+    return meme_file_name_pattern.fullmatch(fileName) is not None
+
+
+def reserve_file_path(baseName, outputFolder, noFileSave=False, extension="png", sharding="none"):
+    while True:
+        filePath, fileName = set_file_path(baseName, outputFolder, extension, sharding)
+        if noFileSave:
+            return filePath, fileName
+        
+        # O_EXCL fails if the file already exists, so a name can only ever be claimed once even by another process
+        try:
+            os.close(os.open(filePath, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            continue
         
-        existing_files = glob.glob(os.path.join(outputFolder, baseName + "_" + timestamp + "_*.png"))
+        return filePath, fileName
 
-       
-        max_counter = 0
-        for file in existing_files:
+    
+
+class MemeStore:
+    def __init__(self, root):
+        self.root = root
+        self.index_path = os.path.join(root, "index.sqlite3")
+        self.local = threading.local()
+        os.makedirs(root, exist_ok=True)
+        with self.connect() as connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS memes (
+                id TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                created REAL NOT NULL,
+                user_prompt TEXT,
+                meme_text TEXT,
+                image_prompt TEXT,
+                platform TEXT,
+                size_bytes INTEGER
+            )""")
+
+    def connect(self):
+        # SQLite connections can't be shared between threads, or carried over into a forked process
+        connection = getattr(self.local, "connection", None)
+        if connection is None or self.local.pid != os.getpid():
+            connection = sqlite3.connect(self.index_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def add(self, fileName, filePath, userPrompt, AiMemeDict, platform, size_bytes):
+        with self.connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO memes (id, path, created, user_prompt, meme_text, image_prompt, platform, size_bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (fileName, os.path.relpath(filePath, self.root), time.time(), userPrompt, AiMemeDict['meme_text'], AiMemeDict['image_prompt'], platform, size_bytes),
+            )
+
+    def lookup(self, fileName):
+        row = self.connect().execute("SELECT path FROM memes WHERE id = ?", (fileName,)).fetchone()
+        if row is None:
+            return None
+        
+        return os.path.join(self.root, row[0])
+
+    def get_info(self, fileName):
+        cursor = self.connect().execute("SELECT * FROM memes WHERE id = ?", (fileName,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        
+        return dict(zip([column[0] for column in cursor.description], row))
+
+
+def get_meme_store(root):
+    root = os.path.abspath(root)
+    
+    with meme_stores_lock:
+        if root not in meme_stores:
+            meme_stores[root] = MemeStore(root)
+    
+    return meme_stores[root]
+
+
+class Metrics:
+    buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+    descriptions = {
+        "meme_stage_seconds": "Time spent in each stage of generating a meme.",
+        "render_cpu_seconds": "CPU time spent rendering memes, in the rendering thread or render pool process.",
+        "image_request_seconds": "Time spent waiting for the image platform.",
+        "memes_generated_total": "Memes generated.",
+        "meme_errors_total": "Memes that failed, by the stage they failed in.",
+        "cache_hits_total": "Captions and images served from a cache.",
+        "cache_misses_total": "Captions and images that were not in a cache.",
+        "api_retries_total": "API requests that were retried.",
+        "image_failovers_total": "Image requests moved to another platform after the first one failed.",
+        "rate_limit_wait_seconds": "Time API requests were held back to stay within the configured rate limits.",
+        "api_hedged_requests_total": "Image requests that were sent a second time because the first one was slower than usual.",
+        "jobs_started_total": "Web app meme jobs started.",
+        "jobs_finished_total": "Web app meme jobs finished, by outcome.",
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0, "max": 0.0}
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["buckets"][index] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+            histogram["max"] = max(histogram["max"], seconds)
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+    def render_prometheus(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: dict(value, buckets=list(value["buckets"])) for key, value in self.histograms.items()}
+        
+        lines = []
+        for name in sorted({key[0] for key in counters}):
+            lines.append(f"# HELP {name} {self.descriptions.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            for (metricName, labels), value in sorted(counters.items()):
+                if metricName == name:
+                    lines.append(f"{name}{self.format_labels(labels)} {value}")
+        for name in sorted({key[0] for key in histograms}):
+            lines.append(f"# HELP {name} {self.descriptions.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for (metricName, labels), histogram in sorted(histograms.items()):
+                if metricName != name:
+                    continue
+                for bound, count in zip(self.buckets, histogram["buckets"]):
+                    lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {histogram['sum']:.6f}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {histogram['count']}")
+        
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        
+        lines = []
+        for (name, labels), histogram in histograms:
+            label = name.replace("_seconds", "") + " " + ",".join(str(value) for key, value in labels)
+            lines.append(f"   {label:<28} {histogram['count']:>5} x   avg {histogram['sum'] / histogram['count']:.3f}s   max {histogram['max']:.3f}s")
+        for (name, labels), value in counters:
+            if name != "memes_generated_total":
+                lines.append(f"   {name + self.format_labels(labels):<40} {value}")
+        
+        return "\n".join(lines)
+
+
+metrics = Metrics()
+
+# Rate limit buckets. OpenAI's chat and image models have separate limits on the same key.
+image_rate_limit_buckets = {"openai": "openai_images", "stability": "stability", "clipdrop": "clipdrop"}
+rate_limit_config = RateLimitConfigTupleClass(requests_per_minute={}, tokens_per_minute={}, folder="")
+# Roughly what one reply with a meme text and an image prompt costs, for the tokens per minute limit
+reply_token_estimate = 60
+
+
+def lock_file(fd):
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+
+
+def unlock_file(fd):
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class RateLimiter:
+    # Levels of the requests and tokens buckets, and when they were last topped up
+    state = struct.Struct("ddd")
+
+    def __init__(self, path, requests_per_minute=0, tokens_per_minute=0):
+        self.path = path
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        # File locks are held per process, so threads of the same process queue up here first
+        self.lock = threading.Lock()
+
+    def take(self, requests, tokens, commit):
+        # The buckets live in a small file locked while it is updated, so every worker process on the machine draws from the same ones
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
             try:
-                counter = int(os.path.basename(file).split('_')[-1].split('.')[0])
-                max_counter = max(max_counter, counter)
-            except ValueError:
-                pass
+                lock_file(fd)
+                try:
+                    data = os.read(fd, self.state.size)
+                    now = time.time()
+                    if len(data) == self.state.size:
+                        requestLevel, tokenLevel, updated = self.state.unpack(data)
+                    else:
+                        requestLevel, tokenLevel, updated = self.requests_per_minute, self.tokens_per_minute, now
+                    
+                    elapsed = max(0.0, now - updated)
+                    requestLevel = min(self.requests_per_minute, requestLevel + elapsed * self.requests_per_minute / 60)
+                    tokenLevel = min(self.tokens_per_minute, tokenLevel + elapsed * self.tokens_per_minute / 60)
+                    
+                    # Taking more than is left drives a bucket below zero, which queues the caller behind everyone who took before it
+                    waitSeconds = 0.0
+                    if self.requests_per_minute:
+                        waitSeconds = max(waitSeconds, (requests - requestLevel) * 60 / self.requests_per_minute)
+                    if self.tokens_per_minute:
+                        waitSeconds = max(waitSeconds, (tokens - tokenLevel) * 60 / self.tokens_per_minute)
+                    
+                    if commit:
+                        os.lseek(fd, 0, os.SEEK_SET)
+                        os.write(fd, self.state.pack(requestLevel - requests, tokenLevel - tokens, now))
+                finally:
+                    unlock_file(fd)
+            finally:
+                os.close(fd)
         
-        return max_counter + 1
+        return waitSeconds
+
+    def reserve(self, requests=1, tokens=0):
+        # Takes the capacity now and returns how long to wait before sending, so async code can sleep without blocking a thread
+        return self.take(requests, tokens, commit=True)
+
+    def peek(self, requests=1, tokens=0):
+        return self.take(requests, tokens, commit=False)
+
+    def wait(self, requests=1, tokens=0):
+        waitSeconds = self.reserve(requests, tokens)
+        if waitSeconds > 0:
+            time.sleep(waitSeconds)
+        
+        return waitSeconds
+
+
+def set_rate_limits(rateLimitConfig):
+    global rate_limit_config
+    rate_limit_config = rateLimitConfig
+
 
+def get_rate_limiter(bucket, api_key):
+    requests_per_minute = rate_limit_config.requests_per_minute.get(bucket, 0)
+    tokens_per_minute = rate_limit_config.tokens_per_minute.get(bucket, 0)
+    if not requests_per_minute and not tokens_per_minute:
+        return None
     
-    timestamp = datetime.now().strftime("%Y-%m-%d-%H-%M")
+    # Limits are per key, and the file name only holds a hash of it
+    keyHash = hashlib.sha256(str(api_key).encode("utf-8")).hexdigest()[:16]
+    folder = rate_limit_config.folder or os.path.join(tempfile.gettempdir(), "meme_generator_rate_limits")
+    registryKey = (bucket, keyHash, requests_per_minute, tokens_per_minute, folder)
     
+    with rate_limiters_lock:
+        if registryKey not in rate_limiters:
+            os.makedirs(folder, exist_ok=True)
+            rate_limiters[registryKey] = RateLimiter(os.path.join(folder, f"{bucket}_{keyHash}.bucket"), requests_per_minute, tokens_per_minute)
+    
+    return rate_limiters[registryKey]
+
 
-    if not os.path.exists(outputFolder):
-        os.makedirs(outputFolder)
+def wait_for_rate_limit(bucket, api_key, tokens=0):
+    rateLimiter = get_rate_limiter(bucket, api_key)
+    if rateLimiter is None:
+        return 0.0
     
+    waitSeconds = rateLimiter.reserve(tokens=tokens)
+    if waitSeconds > 0:
+        print(f"   Waiting {waitSeconds:.1f} seconds for the {bucket} rate limit...")
+        time.sleep(waitSeconds)
+    metrics.observe("rate_limit_wait_seconds", waitSeconds, bucket=bucket)
     
-    file_counter = get_next_counter()
+    return waitSeconds
 
+
+async def async_wait_for_rate_limit(bucket, api_key, tokens=0):
+    import asyncio
     
-    fileName = baseName + "_" + timestamp + "_" + str(file_counter) + ".png"
-    filePath = os.path.join(outputFolder, fileName)
+    rateLimiter = get_rate_limiter(bucket, api_key)
+    if rateLimiter is None:
+        return 0.0
     
-    return filePath, fileName
+    # The file lock can be held by another process for a moment, so it is taken off the event loop
+    waitSeconds = await asyncio.to_thread(rateLimiter.reserve, tokens=tokens)
+    if waitSeconds > 0:
+        print(f"   Waiting {waitSeconds:.1f} seconds for the {bucket} rate limit...")
+        await asyncio.sleep(waitSeconds)
+    metrics.observe("rate_limit_wait_seconds", waitSeconds, bucket=bucket)
+    
+    return waitSeconds
+
+
+class GenerationLog:
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5, flush_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.records = queue.Queue()
+        self.flush_marker = object()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+
+    def write(self, record):
+        # Records are only queued here, the background thread writes them out in batches
+        with self.writer_lock:
+            if self.writer is None or not self.writer.is_alive():
+                self.writer = threading.Thread(target=self.run_writer, daemon=True)
+                self.writer.start()
+        self.records.put(record)
+
+    def flush(self):
+        # The marker makes the writer write what it has right away, instead of waiting for the rest of its batch
+        if self.writer is not None:
+            self.records.put(self.flush_marker)
+        self.records.join()
+
+    def run_writer(self):
+        while True:
+            batch = [self.records.get()]
+            # Wait a moment so records from other memes of the batch can go out in the same write
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not self.flush_marker and len(batch) < 1000:
+                try:
+                    batch.append(self.records.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                records = [record for record in batch if record is not self.flush_marker]
+                if records:
+                    self.write_batch(records)
+            except OSError:
+                traceback.print_exc()
+            finally:
+                for _ in batch:
+                    self.records.task_done()
+
+    def write_batch(self, batch):
+        lines = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in batch)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        
+        # One write per batch in append mode, so lines from other processes writing the same log don't get mixed up
+        with open(self.path, "a", encoding="utf-8") as log_file:
+            log_file.write(lines)
+            size = log_file.tell()
+        
+        if self.max_bytes and size >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        for index in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        if self.backup_count:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+
+def get_generation_log(logFolder, max_mb=10, backup_count=5):
+    path = os.path.abspath(os.path.join(logFolder, "log.jsonl"))
+    
+    with generation_logs_lock:
+        if path not in generation_logs:
+            generation_logs[path] = GenerationLog(path, int(max_mb * 1024 * 1024), backup_count)
+    
+    return generation_logs[path]
+
+
+def flush_generation_logs():
+    for generationLog in list(generation_logs.values()):
+        generationLog.flush()
+
 
+def read_log_records(log_path):
+    paths = sorted(glob.glob(glob.escape(log_path) + ".*"), key=lambda path: -int(path.rsplit(".", 1)[-1]) if path.rsplit(".", 1)[-1].isdigit() else 0)
+    for path in paths + [log_path]:
+        if not os.path.isfile(path):
+            continue
+        with open(path, encoding="utf-8") as log_file:
+            for line in log_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    pass
+
+
+def percentile(sortedValues, percent):
+    if not sortedValues:
+        return None
+    rank = max(0, math.ceil(percent / 100 * len(sortedValues)) - 1)
     
+    return sortedValues[rank]
 
-def write_log_file(userPrompt, AiMemeDict, filePath, logFolder, basic, special, platform):
-    # Get file name from path
-    memeFileName = os.path.basename(filePath)
-    with open(os.path.join(logFolder, "log.txt"), "a", encoding='utf-8') as log_file:
-        log_file.write(textwrap.dedent(f"""
-                       Meme File Name: {memeFileName}
-                       AI Basic Instructions: {basic}
-                       AI Special Image Instructions: {special}
-                       User Prompt: '{userPrompt}'
-                       Chat Bot Meme Text: {AiMemeDict['meme_text']}
-                       Chat Bot Image Prompt: {AiMemeDict['image_prompt']}
-                       Image Generation Platform: {platform}
-                       \n"""))
 
+def print_log_stats(log_path, platform=None):
+    records = [record for record in read_log_records(log_path) if not platform or record.get("platform") == platform]
+    if not records:
+        print(f"No records found in {log_path}")
+        return
+    
+    print(f"\n{len(records)} memes logged in {log_path}" + (f" (platform: {platform})" if platform else ""))
+    print(f"\n  {'Stage':<10}{'Count':>8}{'p50':>10}{'p90':>10}{'p99':>10}{'Max':>10}")
+    stages = sorted({stage for record in records for stage in record.get("timings", {})})
+    for stage in stages:
+        values = sorted(record["timings"][stage] for record in records if stage in record.get("timings", {}))
+        print(f"  {stage:<10}{len(values):>8}" + "".join(f"{percentile(values, percent):>9.3f}s" for percent in (50, 90, 99, 100)))
+    
+    for cacheName in ("caption_cache_hit", "image_cache_hit"):
+        hits = sum(1 for record in records if record.get(cacheName))
+        print(f"\n  {cacheName.replace('_', ' ').capitalize()}s: {hits} of {len(records)} ({hits / len(records):.0%})", end="")
+    print()
+    
 
 def parse_meme(message):
     
@@ -333,27 +1028,310 @@ def parse_meme(message):
         }
     else:
         return None
+
+
+def parse_meme_reply(message):
+    memeDict = parse_meme(message)
+    if memeDict is None:
+        raise ValueError("The chat reply did not contain a meme text and an image prompt.")
+    
+    return memeDict
+
+
+def parse_memes(message):
+    memeDicts = []
+    
+    # Each pair starts at its own "Meme Text: " label, so split in front of every label and parse the pieces one by one
+    for chunk in re.split(r'(?=Meme Text: )', message):
+        memeDict = parse_meme(chunk)
+        if memeDict:
+            # An image prompt is one line. Anything after it, like a "Meme 2:" heading, belongs to the next pair.
+            imagePrompt = memeDict['image_prompt'].strip().split('\n', 1)[0]
+            # Drop any list numbering the chat bot put in front of the next pair on the same line
+            memeDict['image_prompt'] = re.sub(r'\s*(?:\d+[.)]|[-*])?\s*$', '', imagePrompt)
+            memeDicts.append(memeDict)
+    
+    return memeDicts
+
+
+def construct_batch_user_message(userMessage, meme_count):
+    return f'{userMessage}\n\n(Create {meme_count} different memes for this, each with its own idea. Respond with {meme_count} "Meme Text: " and "Image Prompt: " pairs, one pair after another in the format described, and nothing else.)'
     
 
-def send_and_receive_message(openai_api, text_model, userMessage, conversationTemp, temperature=0.5):
+class CaptionCache:
+    def __init__(self, pool_size, max_prompts, reuse_ratio):
+        self.pool_size = pool_size
+        self.max_prompts = max_prompts
+        self.reuse_ratio = reuse_ratio
+        self.hits = 0
+        self.misses = 0
+        self.pools = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(text_model, systemPrompt, userMessage, temperature):
+        return (text_model, systemPrompt, userMessage, float(temperature))
+
+    def sample(self, key):
+        with self.lock:
+            pool = self.pools.get(key)
+            # Only a share of the requests reuse a caption, the rest go to the API so the pool keeps getting fresh ones
+            if pool and random.random() < self.reuse_ratio:
+                self.pools.move_to_end(key)
+                self.hits += 1
+                return dict(random.choice(pool))
+            self.misses += 1
+            return None
+
+    def add(self, key, memeDict):
+        with self.lock:
+            pool = self.pools.setdefault(key, [])
+            self.pools.move_to_end(key)
+            pool.append(dict(memeDict))
+            if len(pool) > self.pool_size:
+                pool.pop(0)
+            while len(self.pools) > self.max_prompts:
+                self.pools.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "prompts": len(self.pools)}
+
+
+def get_caption_cache(pool_size, max_prompts, reuse_ratio):
+    global caption_cache
+    
+    with caption_cache_lock:
+        if caption_cache is None:
+            caption_cache = CaptionCache(pool_size, max_prompts, reuse_ratio)
+        else:
+            caption_cache.pool_size = pool_size
+            caption_cache.max_prompts = max_prompts
+            caption_cache.reuse_ratio = reuse_ratio
+    
+    return caption_cache
+
+
+def estimate_message_tokens(message):
+    # Roughly four characters per token, plus the few tokens of overhead the API adds per message
+    return len(message["content"]) // 4 + 4
+
+
+def trim_conversation(conversationTemp, conversationPolicy=None):
+    if not conversationPolicy or conversationPolicy.mode == "full":
+        return list(conversationTemp)
+    
+    systemMessages = [message for message in conversationTemp if message["role"] == "system"]
+    history = [message for message in conversationTemp if message["role"] != "system"]
+    
+    if conversationPolicy.mode == "stateless":
+        history = history[-1:]
+    elif conversationPolicy.mode == "sliding_window":
+        history = history[-max(1, conversationPolicy.window):]
+    elif conversationPolicy.mode == "token_budget":
+        budget = conversationPolicy.token_budget - sum(estimate_message_tokens(message) for message in systemMessages)
+        keep = 1
+        used = estimate_message_tokens(history[-1]) if history else 0
+        for message in reversed(history[:-1]):
+            used += estimate_message_tokens(message)
+            if used > budget:
+                break
+            keep += 1
+        history = history[-keep:]
+    
+    # The history sent must not start with a reply that has lost the message it was answering
+    while len(history) > 1 and history[0]["role"] != "user":
+        history = history[1:]
+    
+    return systemMessages + history
+
+
+def record_reply(conversationTemp, chatResponseMessage, conversationPolicy=None):
+    conversationTemp.append({"role": "assistant", "content": chatResponseMessage})
+    # Trim the stored history too, so it doesn't keep growing in memory over a long batch
+    conversationTemp[:] = trim_conversation(conversationTemp, conversationPolicy)
+
+
+def send_and_receive_message(openai_api, text_model, userMessage, conversationTemp, temperature=0.5, conversationPolicy=None):
     
     conversationTemp.append({"role": "user", "content": userMessage})
     
+    messages = trim_conversation(conversationTemp, conversationPolicy)
+    wait_for_rate_limit("openai_chat", getattr(openai_api, "api_key", ""), sum(estimate_message_tokens(message) for message in messages) + reply_token_estimate)
     print("Sending request to write meme...")
     chatResponse = openai_api.chat.completions.create(
         model=text_model,
-        messages=conversationTemp,
+        messages=messages,
         temperature=temperature
         )
 
     chatResponseMessage = chatResponse.choices[0].message.content
     chatResponseRole = chatResponse.choices[0].message.role
+    record_reply(conversationTemp, chatResponseMessage, conversationPolicy)
 
     return chatResponseMessage
 
 
-def create_meme(image_path, top_text, filePath, fontFile, noFileSave=False, min_scale=0.05, buffer_scale=0.03, font_scale=1):
+def start_batch_message(userMessage, conversationTemp, meme_count, batch_mode="prompt", conversationPolicy=None):
+    # "choices" asks the API itself for several completions of the normal prompt, "prompt" asks for every meme in a single reply
+    if batch_mode == "choices":
+        conversationTemp.append({"role": "user", "content": userMessage})
+    else:
+        conversationTemp.append({"role": "user", "content": construct_batch_user_message(userMessage, meme_count)})
+    
+    messages = trim_conversation(conversationTemp, conversationPolicy)
+    print(f"Sending request to write {meme_count} memes...")
+    
+    return messages, sum(estimate_message_tokens(message) for message in messages) + reply_token_estimate * meme_count
+
+
+def read_batch_reply(chatResponse, conversationTemp, meme_count, batch_mode="prompt", conversationPolicy=None):
+    record_reply(conversationTemp, chatResponse.choices[0].message.content, conversationPolicy)
+
+    if batch_mode == "choices":
+        memeDicts = [parse_meme(choice.message.content) for choice in chatResponse.choices]
+        memeDicts = [memeDict for memeDict in memeDicts if memeDict]
+    else:
+        memeDicts = parse_memes(chatResponse.choices[0].message.content)
+
+    return memeDicts[:meme_count]
+
+
+def send_and_receive_batch_message(openai_api, text_model, userMessage, conversationTemp, meme_count, temperature=0.5, batch_mode="prompt", conversationPolicy=None):
+    messages, tokens = start_batch_message(userMessage, conversationTemp, meme_count, batch_mode, conversationPolicy)
+    wait_for_rate_limit("openai_chat", getattr(openai_api, "api_key", ""), tokens)
+    chatResponse = openai_api.chat.completions.create(
+        model=text_model,
+        messages=messages,
+        temperature=temperature,
+        n=meme_count if batch_mode == "choices" else 1
+        )
+
+    return read_batch_reply(chatResponse, conversationTemp, meme_count, batch_mode, conversationPolicy)
+
+
+async def async_send_and_receive_message(async_openai, text_model, userMessage, conversationTemp, temperature=0.5, conversationPolicy=None):
+    conversationTemp.append({"role": "user", "content": userMessage})
+    
+    messages = trim_conversation(conversationTemp, conversationPolicy)
+    await async_wait_for_rate_limit("openai_chat", getattr(async_openai, "api_key", ""), sum(estimate_message_tokens(message) for message in messages) + reply_token_estimate)
+    print("Sending request to write meme...")
+    chatResponse = await async_openai.chat.completions.create(
+        model=text_model,
+        messages=messages,
+        temperature=temperature
+        )
+    
+    chatResponseMessage = chatResponse.choices[0].message.content
+    record_reply(conversationTemp, chatResponseMessage, conversationPolicy)
+    
+    return chatResponseMessage
+
+
+async def async_send_and_receive_batch_message(async_openai, text_model, userMessage, conversationTemp, meme_count, temperature=0.5, batch_mode="prompt", conversationPolicy=None):
+    messages, tokens = start_batch_message(userMessage, conversationTemp, meme_count, batch_mode, conversationPolicy)
+    await async_wait_for_rate_limit("openai_chat", getattr(async_openai, "api_key", ""), tokens)
+    chatResponse = await async_openai.chat.completions.create(
+        model=text_model,
+        messages=messages,
+        temperature=temperature,
+        n=meme_count if batch_mode == "choices" else 1
+        )
+    
+    return read_batch_reply(chatResponse, conversationTemp, meme_count, batch_mode, conversationPolicy)
+
+
+@functools.lru_cache(maxsize=256)
+def load_font(fontFile, font_size):
+    from PIL import ImageFont
+    # Loading a font reads and parses the whole TTF file, so each size is only loaded once per process
+    return ImageFont.truetype(fontFile, font_size)
+
+
+@functools.lru_cache(maxsize=2)
+def get_measure_draw(fontmode):
+    from PIL import Image, ImageDraw
+    # Text is measured on a tiny image of a mode with the same font mode as the meme image, so the sizes match exactly
+    return ImageDraw.Draw(Image.new("1" if fontmode == "1" else "L", (1, 1)))
+
+
+@functools.lru_cache(maxsize=4096)
+def measure_text_width(fontFile, font_size, text, fontmode="L"):
+    return get_measure_draw(fontmode).textbbox((0,0), text, font=load_font(fontFile, font_size))[2]
+
+
+def wrap_text(words, fontFile, font_size, max_width, fontmode="L", exact=True):
+    if exact:
+        lines = [words[0]]
+        for word in words[1:]:
+            new_line = (lines[-1] + ' ' + word).rstrip()
+            if measure_text_width(fontFile, font_size, new_line, fontmode) > max_width:
+                lines.append(word)
+            else:
+                lines[-1] = new_line
+        return '\n'.join(lines)
+
+    # Each word is measured once and the line widths are added up, instead of measuring every growing line again
+    fnt = load_font(fontFile, font_size)
+    space_width = fnt.getlength(' ')
+    lines = [words[0]]
+    line_width = fnt.getlength(words[0])
+    for word in words[1:]:
+        word_width = fnt.getlength(word)
+        if line_width + space_width + word_width > max_width:
+            lines.append(word)
+            line_width = word_width
+        else:
+            lines[-1] += ' ' + word
+            line_width += space_width + word_width
+    return '\n'.join(lines)
+
+
+def fit_meme_text(top_text, fontFile, image_width, buffer_size, fontmode="L", min_scale=0.05, font_scale=1, exact=True):
+    max_width = image_width - 2 * buffer_size
+    words = top_text.split()
+    
+    if exact:
+        # Same steps as always: shrink by 10% until the text fits on one line, and wrap it at the last size once it gets too small
+        font_size = int(font_scale * image_width)
+        fnt_size = font_size
+        while measure_text_width(fontFile, fnt_size, top_text, fontmode) > max_width:
+            font_size *= 0.9
+            if font_size < min_scale * image_width:
+                return load_font(fontFile, fnt_size), wrap_text(words, fontFile, fnt_size, max_width, fontmode), font_size
+            fnt_size = int(font_size)
+        return load_font(fontFile, fnt_size), top_text, font_size
+    
+    # Binary search for the largest whole font size that fits on one line
+    low = math.ceil(min_scale * image_width)
+    high = int(font_scale * image_width)
+    if measure_text_width(fontFile, high, top_text, fontmode) <= max_width:
+        return load_font(fontFile, high), top_text, high
+    if measure_text_width(fontFile, low, top_text, fontmode) > max_width:
+        return load_font(fontFile, low), wrap_text(words, fontFile, low, max_width, fontmode, exact=False), low
+    while high - low > 1:
+        middle = (low + high) // 2
+        if measure_text_width(fontFile, middle, top_text, fontmode) <= max_width:
+            low = middle
+        else:
+            high = middle
+    return load_font(fontFile, low), top_text, low
+
+
+def create_meme(image_path, top_text, filePath, fontFile, noFileSave=False, min_scale=0.05, buffer_scale=0.03, font_scale=1, text_layout="exact", output_format="png", compress_level=6, quality=90):
+    virtualMemeFile, renderTimings = render_meme_file(image_path, top_text, filePath, fontFile, noFileSave, min_scale, buffer_scale, font_scale, text_layout, output_format, compress_level, quality)
+    
+    return virtualMemeFile
+
+
+def render_meme_file(image_path, top_text, filePath, fontFile, noFileSave=False, min_scale=0.05, buffer_scale=0.03, font_scale=1, text_layout="exact", output_format="png", compress_level=6, quality=90, derivative_widths=None):
     print("Creating meme image...")
+    # The timings are returned rather than recorded here, because this may run in a render pool process
+    renderTimings = {}
+    stageStart = time.perf_counter()
+    # CPU time of this thread only, so renders running side by side don't count each other's time, or time spent waiting for the GIL
+    cpuStart = time.thread_time()
+    from PIL import Image, ImageDraw
     
    
     image = Image.open(image_path)
@@ -365,108 +1343,989 @@ def create_meme(image_path, top_text, filePath, fontFile, noFileSave=False, min_
     d = ImageDraw.Draw(image)
 
     
-    words = top_text.split()
-
-   
-    font_size = int(font_scale * image.width)
-    fnt = ImageFont.truetype(fontFile, font_size)
-    wrapped_text = top_text
-
-    
-    while d.textbbox((0,0), wrapped_text, font=fnt)[2] > image.width - 2 * buffer_size:
-        font_size *= 0.9  
-        if font_size < min_scale * image.width:
-            
-            lines = [words[0]]
-            for word in words[1:]:
-                new_line = (lines[-1] + ' ' + word).rstrip()
-                if d.textbbox((0,0), new_line, font=fnt)[2] > image.width - 2 * buffer_size:
-                    lines.append(word)
-                else:
-                    lines[-1] = new_line
-            wrapped_text = '\n'.join(lines)
-            break
-        fnt = ImageFont.truetype(fontFile, int(font_size))
+    fnt, wrapped_text, font_size = fit_meme_text(top_text, fontFile, image.width, buffer_size, d.fontmode, min_scale, font_scale, exact=(text_layout != "fast"))
 
  
     textbbox_val = d.multiline_textbbox((0,0), wrapped_text, font=fnt)
 
     
     band_height = textbbox_val[3] - textbbox_val[1] + int(font_size * 0.1) + 2 * buffer_size
-    band = Image.new('RGBA', (image.width, band_height), (255,255,255,255))
+    # Images without transparency (DALL-E, Stability and ClipDrop all return RGB) are composed and encoded without an alpha channel
+    hasAlpha = image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+    new_img = Image.new('RGBA' if hasAlpha else 'RGB', (image.width, image.height + band_height), (255,255,255,255) if hasAlpha else (255,255,255))
 
    
-    d = ImageDraw.Draw(band)
+    d = ImageDraw.Draw(new_img)
 
   
-    text_x = band.width // 2 
-    text_y = band.height // 2
+    text_x = new_img.width // 2 
+    text_y = band_height // 2
 
-    d.multiline_text((text_x, text_y), wrapped_text, font=fnt, fill=(0,0,0,255), anchor="mm", align="center")
+    d.multiline_text((text_x, text_y), wrapped_text, font=fnt, fill=(0,0,0,255) if hasAlpha else (0,0,0), anchor="mm", align="center")
 
     
-    new_img = Image.new('RGBA', (image.width, image.height + band_height))
-    new_img.paste(band, (0,0))
     new_img.paste(image, (0, band_height))
 
+    renderTimings["compose"] = time.perf_counter() - stageStart
+    stageStart = time.perf_counter()
+
+    # Encode once, and write the same bytes to the file that are returned in memory
+    virtualMemeFile = encode_meme_image(new_img, output_format, compress_level, quality)
+    renderTimings["encode"] = time.perf_counter() - stageStart
+
     if not noFileSave:
       
-        new_img.save(filePath)
+        stageStart = time.perf_counter()
+        with open(filePath, "wb") as memeFile:
+            memeFile.write(virtualMemeFile.getbuffer())
+        renderTimings["write"] = time.perf_counter() - stageStart
         
+        if derivative_widths:
+            # Made from the composed image still in memory, so the saved file doesn't have to be decoded again
+            stageStart = time.perf_counter()
+            save_meme_derivatives(new_img, filePath, derivative_widths, quality)
+            renderTimings["derivatives"] = time.perf_counter() - stageStart
+    
+    renderTimings["cpu"] = time.thread_time() - cpuStart
     
+    return virtualMemeFile, renderTimings
+
+
+def encode_meme_image(image, output_format="png", compress_level=6, quality=90):
+    output_format = output_format.lower()
     virtualMemeFile = io.BytesIO()
-    new_img.save(virtualMemeFile, format="PNG")
     
+    if output_format in ("jpeg", "jpg"):
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image.save(virtualMemeFile, format="JPEG", quality=quality, optimize=True)
+    elif output_format == "webp":
+        image.save(virtualMemeFile, format="WEBP", quality=quality, method=4)
+    else:
+        image.save(virtualMemeFile, format="PNG", compress_level=compress_level)
+    
+    virtualMemeFile.seek(0)
     return virtualMemeFile
+
+
+def get_output_extension(output_format):
+    return {"jpeg": "jpg", "jpg": "jpg", "webp": "webp"}.get(output_format.lower(), "png")
+
+
+def get_derivative_path(filePath, size):
+    # 'meme_..._1-a1b2c3.png' -> 'meme_..._1-a1b2c3.thumb.webp', next to the original so finding the original finds them too
+    return f"{os.path.splitext(filePath)[0]}.{size}.webp"
+
+
+def save_meme_derivatives(image, filePath, derivative_widths, quality=90):
+    from PIL import Image
+    
+    for size, width in derivative_widths.items():
+        derivative = image.copy()
+        # thumbnail() keeps the aspect ratio and never makes an image larger
+        derivative.thumbnail((width, derivative.height), Image.LANCZOS)
+        derivativePath = get_derivative_path(filePath, size)
+        # Written under a temporary name first, so the web app never serves a half written file
+        temporaryPath = f"{derivativePath}.{os.getpid()}.tmp"
+        derivative.save(temporaryPath, format="WEBP", quality=quality, method=4)
+        os.replace(temporaryPath, derivativePath)
     
 
-def image_generation_request(apiKeys, image_prompt, platform, openai_api, stability_api=None):
+def image_generation_request(apiKeys, image_prompt, platform, openai_api, stability_api=None, clipdrop_session=None, timeout=None):
+    wait_for_rate_limit(image_rate_limit_buckets[platform], get_platform_key(apiKeys, platform))
+    
     if platform == "openai":
-        openai_response = openai_api.images.generate(model="dall-e-3", prompt=image_prompt, n=1, size="1024x1024", response_format="b64_json")
-       
-        image_data = b64decode(openai_response.data[0].model_dump()["b64_json"])
-        virtual_image_file = io.BytesIO()
+        params = image_request_params["openai"]
+        # A timeout comes from retrying_image_generation_request(), which does its own retries, so the client's are turned off
+        openai_images = openai_api.with_options(timeout=timeout, max_retries=0).images if timeout else openai_api.images
+        openai_response = openai_images.generate(model=params["model"], prompt=image_prompt, n=1, size=params["size"], response_format="b64_json")
        
-        virtual_image_file.write(image_data)
+        # Read the field directly, model_dump() would copy the whole response just to get at it
+        virtual_image_file = decode_base64_image(openai_response.data[0].b64_json)
     
     if platform == "stability" and stability_api:
-        
-        stability_response = stability_api.generate(
-            prompt=image_prompt,
-            #seed=992446758, 
-            steps=30,       
-            cfg_scale=7.0,  
-            width=1024, 
-            height=1024, 
-            samples=1,
-            sampler=generation.SAMPLER_K_DPMPP_2M  
-                                                   )
-
-       
-        for resp in stability_response:
-            for artifact in resp.artifacts:
-                if artifact.finish_reason == generation.FILTER:
-                    warnings.warn(
-                        "Your request activated the API's safety filters and could not be processed."
-                        "Please modify the prompt and try again.")
-                if artifact.type == generation.ARTIFACT_IMAGE:
-                    
-                    virtual_image_file = io.BytesIO(artifact.binary)
+        if timeout:
+            # The Stability client takes no timeout, so the request is waited for from here and left behind if it runs over
+            executor = ThreadPoolExecutor(max_workers=1)
+            future = executor.submit(stability_image_request, stability_api, image_prompt)
+            executor.shutdown(wait=False)
+            try:
+                virtual_image_file = future.result(timeout=timeout)
+            except FutureTimeoutError:
+                raise ImageRequestTimeoutError("Image request timed out.", platform, timeout)
+        else:
+            virtual_image_file = stability_image_request(stability_api, image_prompt)
 
     if platform == "clipdrop":
-        r = requests.post('https://clipdrop-api.co/text-to-image/v1',
+        import requests
+        r = (clipdrop_session or requests).post('https://clipdrop-api.co/text-to-image/v1',
             files = {
                 'prompt': (None, image_prompt, 'text/plain')
             },
-            headers = { 'x-api-key': apiKeys.clipdrop_key}
+            headers = { 'x-api-key': apiKeys.clipdrop_key},
+            stream = True,
+            timeout = timeout
         )
-        if (r.ok):
-            virtual_image_file = io.BytesIO(r.content) # r.content contains the bytes of the returned image
-        else:
+        with r:
+            if (r.ok):
+                virtual_image_file = read_response_into_buffer(r)
+            else:
+                r.raise_for_status()
+
+    return virtual_image_file
+
+
+def get_platform_key(apiKeys, platform):
+    return {"openai": apiKeys.openai_key, "stability": apiKeys.stability_key, "clipdrop": apiKeys.clipdrop_key}[platform]
+
+
+def stability_image_request(stability_api, image_prompt):
+    import stability_sdk.interfaces.gooseai.generation.generation_pb2 as generation
+    params = image_request_params["stability"]
+    stability_response = stability_api.generate(
+        prompt=image_prompt,
+        #seed=992446758, 
+        steps=params["steps"],       
+        cfg_scale=params["cfg_scale"],  
+        width=1024, 
+        height=1024, 
+        samples=1,
+        sampler=generation.SAMPLER_K_DPMPP_2M  
+                                               )
+
+   
+    for resp in stability_response:
+        for artifact in resp.artifacts:
+            if artifact.finish_reason == generation.FILTER:
+                warnings.warn(
+                    "Your request activated the API's safety filters and could not be processed."
+                    "Please modify the prompt and try again.")
+            if artifact.type == generation.ARTIFACT_IMAGE:
+                
+                # BytesIO shares the memory of a bytes object until it is written to, so this doesn't copy the image
+                virtual_image_file = io.BytesIO(artifact.binary)
+
+    return virtual_image_file
+
+
+def is_module_error(ex, module, *names):
+    # An SDK that was never imported can't have raised anything, so there's no need to import it just for the check
+    loadedModule = sys.modules.get(module)
+    return loadedModule is not None and isinstance(ex, tuple(getattr(loadedModule, name) for name in names))
+
+
+def is_authentication_error(ex):
+    # openai has its own error classes, ClipDrop answers with an HTTP status and Stability with a gRPC one
+    return (isinstance(ex, APIAuthenticationError) or is_module_error(ex, "openai", "AuthenticationError", "PermissionDeniedError")
+        or get_error_status_code(ex) in (401, 403) or get_grpc_status_name(ex) in ("UNAUTHENTICATED", "PERMISSION_DENIED"))
+
+
+def is_batch_fatal_error(ex):
+    # Errors that every other meme in the batch would run into as well
+    return isinstance(ex, (MissingOpenAIKeyError, MissingAPIKeyError, NoFontFileError, ModelNotFoundError)) or is_module_error(ex, "openai", "NotFoundError") or is_authentication_error(ex)
+
+
+def is_retryable_image_error(ex):
+    if isinstance(ex, ImageRequestTimeoutError) or is_module_error(ex, "openai", "APIConnectionError") or is_module_error(ex, "requests", "Timeout", "ConnectionError") or is_module_error(ex, "httpx", "TransportError"):
+        return True
+    
+    status_code = get_error_status_code(ex)
+    if status_code:
+        return status_code == 429 or status_code >= 500
+    
+    return get_grpc_status_name(ex) in ("RESOURCE_EXHAUSTED", "UNAVAILABLE", "DEADLINE_EXCEEDED", "INTERNAL")
+
+
+def get_error_status_code(ex):
+    # openai errors have the HTTP status themselves, requests and httpx errors have it on their response
+    return getattr(ex, "status_code", None) or getattr(getattr(ex, "response", None), "status_code", None)
+
+
+def get_grpc_status_name(ex):
+    # Stability reports errors as gRPC status codes instead of HTTP ones
+    code = getattr(ex, "code", None)
+    if callable(code):
+        return getattr(code(), "name", None)
+    return None
+
+
+def get_retry_after(ex):
+    headers = getattr(getattr(ex, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def retrying_image_generation_request(apiKeys, image_prompt, platform, openai_api, stability_api=None, clipdrop_session=None, retryPolicy=None):
+    if not retryPolicy:
+        return image_generation_request(apiKeys, image_prompt, platform, openai_api, stability_api, clipdrop_session)
+    
+    timeout = retryPolicy.timeouts.get(platform) or None
+    attempt = 0
+    while True:
+        try:
+            return image_generation_request(apiKeys, image_prompt, platform, openai_api, stability_api, clipdrop_session, timeout)
+        except Exception as ex:
+            if attempt >= retryPolicy.max_retries or not is_retryable_image_error(ex):
+                raise
+            # Random delays up to the backoff keep memes that failed together from all retrying at the same moment
+            delay = random.uniform(0, min(retryPolicy.backoff_max, retryPolicy.backoff_base * 2 ** attempt))
+            retryAfter = get_retry_after(ex)
+            if retryAfter is not None:
+                delay = max(delay, min(retryAfter, retryPolicy.backoff_max))
+            print(f"   Image request failed ({type(ex).__name__}), retrying in {delay:.1f} seconds...")
+            metrics.inc("api_retries_total", platform=platform)
+            time.sleep(delay)
+            attempt += 1
+
+
+class LatencyTracker:
+    def __init__(self, max_samples=200, min_samples=20):
+        self.samples = deque(maxlen=max_samples)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, percent):
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            return percentile(sorted(self.samples), percent)
+
+    def average(self):
+        with self.lock:
+            return sum(self.samples) / len(self.samples) if self.samples else None
+
+
+def get_latency_tracker(platform):
+    with image_latency_trackers_lock:
+        if platform not in image_latency_trackers:
+            image_latency_trackers[platform] = LatencyTracker()
+    
+    return image_latency_trackers[platform]
+
+
+def get_image_request_executor():
+    global image_request_executor
+    
+    with image_request_executor_lock:
+        if image_request_executor is None:
+            image_request_executor = ThreadPoolExecutor(max_workers=64, thread_name_prefix="image-request")
+    
+    return image_request_executor
+
+
+def hedged_image_generation_request(apiKeys, image_prompt, platform, openai_api, stability_api=None, clipdrop_session=None, retryPolicy=None):
+    tracker = get_latency_tracker(platform)
+    requestArgs = (apiKeys, image_prompt, platform, openai_api, stability_api, clipdrop_session, retryPolicy)
+    hedgeDelay = tracker.percentile(retryPolicy.hedge_percentile) if retryPolicy and retryPolicy.hedge else None
+    requestStart = time.perf_counter()
+    
+    if hedgeDelay is None:
+        virtual_image_file = retrying_image_generation_request(*requestArgs)
+        tracker.add(time.perf_counter() - requestStart)
+        return virtual_image_file
+    
+    # A request still running after the usual worst case is probably stuck behind something, so a second one is sent and the first answer wins
+    executor = get_image_request_executor()
+    futures = [executor.submit(retrying_image_generation_request, *requestArgs)]
+    done, _ = wait(futures, timeout=hedgeDelay)
+    if not done:
+        metrics.inc("api_hedged_requests_total", platform=platform)
+        futures.append(executor.submit(retrying_image_generation_request, *requestArgs))
+    
+    error = None
+    for future in as_completed(futures):
+        try:
+            virtual_image_file = future.result()
+        except Exception as ex:
+            error = error or ex
+            continue
+        tracker.add(time.perf_counter() - requestStart)
+        return virtual_image_file
+    
+    raise error
+
+
+class ImageProvider:
+    def __init__(self, name, api_key, weight, max_concurrent):
+        self.name = name
+        self.api_key = api_key
+        self.weight = weight
+        self.max_concurrent = max_concurrent
+        self.in_flight = 0
+        self.current_weight = 0
+        self.cooldown_until = 0
+
+    def wait_time(self, now):
+        # Seconds until this provider may be sent another request, not counting the concurrency limit.
+        # The rate limit is only looked at here, the request takes its share of it when it is sent.
+        rateLimiter = get_rate_limiter(image_rate_limit_buckets[self.name], self.api_key)
+        rateWait = rateLimiter.peek() if rateLimiter else 0
+        
+        return max(rateWait, self.cooldown_until - now, 0)
+
+
+class ImageRouter:
+    def __init__(self, apiKeys, platforms, routerConfig):
+        self.strategy = routerConfig.strategy
+        self.cooldown = routerConfig.cooldown
+        self.providers = [ImageProvider(
+            platform,
+            get_platform_key(apiKeys, platform),
+            routerConfig.weights.get(platform, 1),
+            int(routerConfig.max_concurrent.get(platform, 0)),
+        ) for platform in platforms if routerConfig.weights.get(platform, 1) > 0]
+        if not self.providers:
+            raise NoImagePlatformError("No image platform is enabled.", platforms)
+        self.condition = threading.Condition()
+
+    @property
+    def platforms(self):
+        return [provider.name for provider in self.providers]
+
+    def pick(self, available):
+        if self.strategy == "least_latency":
+            # Platforms without timings yet count as instant, so each of them gets tried early on
+            return min(available, key=lambda provider: ((get_latency_tracker(provider.name).average() or 0) * (provider.in_flight + 1) / provider.weight, provider.in_flight))
+        
+        # Smooth weighted round-robin: spreads each platform's share evenly instead of sending its requests in a row
+        totalWeight = sum(provider.weight for provider in available)
+        for provider in available:
+            provider.current_weight += provider.weight
+        chosen = max(available, key=lambda provider: provider.current_weight)
+        chosen.current_weight -= totalWeight
+        
+        return chosen
+
+    def acquire(self, exclude=()):
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                candidates = [provider for provider in self.providers if provider.name not in exclude]
+                if not candidates:
+                    return None
+                
+                free = [provider for provider in candidates if not provider.max_concurrent or provider.in_flight < provider.max_concurrent]
+                available = [provider for provider in free if provider.wait_time(now) == 0]
+                if available:
+                    provider = self.pick(available)
+                    provider.in_flight += 1
+                    return provider
+                
+                # Wait for the first rate limit or cooldown to run out, or for a running request to finish
+                self.condition.wait(timeout=min(provider.wait_time(now) for provider in free) if free else None)
+
+    def release(self, provider, error=None):
+        with self.condition:
+            provider.in_flight -= 1
+            if error is not None and is_retryable_image_error(error):
+                # Rate limited or down, so the other platforms take its requests for a while
+                retryAfter = get_retry_after(error)
+                provider.cooldown_until = time.monotonic() + (retryAfter if retryAfter is not None else self.cooldown)
+            self.condition.notify_all()
+
+    def request(self, apiKeys, image_prompt, openai_api, stability_api=None, clipdrop_session=None, retryPolicy=None):
+        # Every platform gets one try per round, failing over to the next one, and rounds are retried as set by the retry policy
+        attemptPolicy = retryPolicy._replace(max_retries=0) if retryPolicy else None
+        rounds = retryPolicy.max_retries + 1 if retryPolicy else 1
+        lastError = None
+        
+        for attempt in range(rounds):
+            tried = set()
+            while True:
+                provider = self.acquire(tried)
+                if provider is None:
+                    break
+                if tried:
+                    metrics.inc("image_failovers_total", platform=provider.name)
+                tried.add(provider.name)
+                try:
+                    virtual_image_file = hedged_image_generation_request(apiKeys, image_prompt, provider.name, openai_api, stability_api, clipdrop_session, attemptPolicy)
+                except Exception as ex:
+                    self.release(provider, ex)
+                    lastError = ex
+                    print(f"   {provider.name} image request failed ({str(ex) or type(ex).__name__})")
+                    continue
+                self.release(provider)
+                return virtual_image_file, provider.name
+            
+            if attempt < rounds - 1:
+                delay = random.uniform(0, min(retryPolicy.backoff_max, retryPolicy.backoff_base * 2 ** attempt))
+                metrics.inc("api_retries_total", platform="auto")
+                time.sleep(delay)
+        
+        raise lastError
+
+
+async def async_image_generation_request(apiKeys, image_prompt, platform, async_openai, stability_api=None, clipdrop_client=None, timeout=None):
+    import asyncio
+    
+    await async_wait_for_rate_limit(image_rate_limit_buckets[platform], get_platform_key(apiKeys, platform))
+    
+    if platform == "openai":
+        params = image_request_params["openai"]
+        openai_images = async_openai.with_options(timeout=timeout, max_retries=0).images if timeout else async_openai.images
+        openai_response = await openai_images.generate(model=params["model"], prompt=image_prompt, n=1, size=params["size"], response_format="b64_json")
+        return decode_base64_image(openai_response.data[0].b64_json)
+    
+    if platform == "stability" and stability_api:
+        # The Stability SDK only has a blocking gRPC client, so its request waits in a worker thread instead of on the event loop
+        try:
+            return await asyncio.wait_for(asyncio.to_thread(stability_image_request, stability_api, image_prompt), timeout)
+        except asyncio.TimeoutError:
+            raise ImageRequestTimeoutError("Image request timed out.", platform, timeout)
+    
+    if platform == "clipdrop":
+        async with clipdrop_client.stream("POST", 'https://clipdrop-api.co/text-to-image/v1', files={'prompt': (None, image_prompt, 'text/plain')}, headers={'x-api-key': apiKeys.clipdrop_key}, timeout=timeout) as r:
             r.raise_for_status()
+            virtual_image_file = preallocate_buffer(int(r.headers.get('Content-Length') or 0))
+            async for chunk in r.aiter_bytes():
+                virtual_image_file.write(chunk)
+        virtual_image_file.truncate()
+        virtual_image_file.seek(0)
+        return virtual_image_file
+    
+    raise InvalidImagePlatformError(f'Invalid image platform provided.', platform, list(image_rate_limit_buckets))
+
+
+async def async_retrying_image_generation_request(apiKeys, image_prompt, platform, async_openai, stability_api=None, clipdrop_client=None, retryPolicy=None):
+    import asyncio
+    
+    retryPolicy = retryPolicy or default_image_retry_policy._replace(max_retries=0, timeouts={})
+    timeout = retryPolicy.timeouts.get(platform) or None
+    attempt = 0
+    while True:
+        try:
+            return await async_image_generation_request(apiKeys, image_prompt, platform, async_openai, stability_api, clipdrop_client, timeout)
+        except Exception as ex:
+            if attempt >= retryPolicy.max_retries or not is_retryable_image_error(ex):
+                raise
+            delay = random.uniform(0, min(retryPolicy.backoff_max, retryPolicy.backoff_base * 2 ** attempt))
+            retryAfter = get_retry_after(ex)
+            if retryAfter is not None:
+                delay = max(delay, min(retryAfter, retryPolicy.backoff_max))
+            print(f"   Image request failed ({type(ex).__name__}), retrying in {delay:.1f} seconds...")
+            metrics.inc("api_retries_total", platform=platform)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def async_hedged_image_generation_request(apiKeys, image_prompt, platform, async_openai, stability_api=None, clipdrop_client=None, retryPolicy=None):
+    import asyncio
+    
+    tracker = get_latency_tracker(platform)
+    requestArgs = (apiKeys, image_prompt, platform, async_openai, stability_api, clipdrop_client, retryPolicy)
+    hedgeDelay = tracker.percentile(retryPolicy.hedge_percentile) if retryPolicy and retryPolicy.hedge else None
+    requestStart = time.perf_counter()
+    
+    if hedgeDelay is None:
+        virtual_image_file = await async_retrying_image_generation_request(*requestArgs)
+        tracker.add(time.perf_counter() - requestStart)
+        return virtual_image_file
+    
+    # Same as hedged_image_generation_request(), except the slower request is cancelled once the other one has answered
+    tasks = [asyncio.ensure_future(async_retrying_image_generation_request(*requestArgs))]
+    done, _ = await asyncio.wait(tasks, timeout=hedgeDelay)
+    if not done:
+        metrics.inc("api_hedged_requests_total", platform=platform)
+        tasks.append(asyncio.ensure_future(async_retrying_image_generation_request(*requestArgs)))
+    
+    error = None
+    try:
+        for finished in asyncio.as_completed(tasks):
+            try:
+                virtual_image_file = await finished
+            except Exception as ex:
+                error = error or ex
+                continue
+            tracker.add(time.perf_counter() - requestStart)
+            return virtual_image_file
+    finally:
+        for task in tasks:
+            task.cancel()
+    
+    raise error
+
+
+def parse_platform_values(value, cast=float):
+    # "openai:1, clipdrop:2" -> {"openai": 1.0, "clipdrop": 2.0}
+    platformValues = {}
+    for item in str(value).split(","):
+        if ":" in item:
+            platform, _, number = item.partition(":")
+            platformValues[platform.strip().lower()] = cast(number.strip())
+    
+    return platformValues
+
 
+def get_image_router(apiKeys, routerConfig):
+    platforms = ["openai"] + (["stability"] if apiKeys.stability_key else []) + (["clipdrop"] if apiKeys.clipdrop_key else [])
+    registryKey = (apiKeys, routerConfig.strategy, routerConfig.cooldown) + tuple(tuple(sorted(values.items())) for values in (routerConfig.weights, routerConfig.max_concurrent))
+    
+    # One router per process, so concurrent batches and web jobs share the platforms' limits
+    with image_routers_lock:
+        if registryKey not in image_routers:
+            image_routers[registryKey] = ImageRouter(apiKeys, platforms, routerConfig)
+    
+    return image_routers[registryKey]
+
+
+def preallocate_buffer(size):
+    virtual_file = io.BytesIO()
+    # Writing the last byte sizes the buffer once, so filling it afterwards never has to grow and copy it
+    if size > 0:
+        virtual_file.seek(size - 1)
+        virtual_file.write(b"\0")
+        virtual_file.seek(0)
+    
+    return virtual_file
+
+
+def decode_base64_image(b64_data, chunk_size=1024 * 1024):
+    # b64decode() would first make a full ASCII copy of the string, decoding in chunks only ever holds one chunk extra
+    chunk_size -= chunk_size % 4
+    # Base64 has at most two padding characters, so only the end is looked at instead of stripping (and copying) the whole string
+    padding = b64_data[-2:].count("=")
+    virtual_image_file = preallocate_buffer(len(b64_data) * 3 // 4 - padding)
+    
+    for start in range(0, len(b64_data), chunk_size):
+        virtual_image_file.write(binascii.a2b_base64(b64_data[start:start + chunk_size]))
+    virtual_image_file.truncate()
+    virtual_image_file.seek(0)
+    
     return virtual_image_file
 
+
+def read_response_into_buffer(response, chunk_size=64 * 1024):
+    # Streams the body into one buffer, instead of response.content collecting the chunks and then joining them into a copy
+    virtual_file = preallocate_buffer(int(response.headers.get('Content-Length') or 0))
+    
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        virtual_file.write(chunk)
+    virtual_file.truncate()
+    virtual_file.seek(0)
+    
+    return virtual_file
+
+class ImageCache:
+    def __init__(self, folder, max_bytes, ttl_seconds):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(folder, exist_ok=True)
+        self.total_bytes = sum(entry.stat().st_size for entry in self.scan_entries())
+
+    @staticmethod
+    def make_key(platform, image_prompt):
+        keyParams = dict(image_request_params.get(platform, {}), platform=platform, prompt=image_prompt)
+        return hashlib.sha256(json.dumps(keyParams, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def get_path(self, key):
+        # Two character shard folders keep any single folder small
+        return os.path.join(self.folder, key[:2], key + ".img")
+
+    def scan_entries(self):
+        for shard in os.scandir(self.folder):
+            if shard.is_dir():
+                yield from (entry for entry in os.scandir(shard.path) if entry.name.endswith(".img"))
+
+    def get(self, key):
+        return self.get_first([key])[1]
+
+    def get_first(self, keys):
+        # However many keys are tried, it is one lookup, so a routed prompt that no platform has cached counts as a single miss
+        for key in keys:
+            virtual_image_file = self.read(key)
+            if virtual_image_file is not None:
+                with self.lock:
+                    self.hits += 1
+                return key, virtual_image_file
+        
+        with self.lock:
+            self.misses += 1
+        return None, None
+
+    def read(self, key):
+        path = self.get_path(key)
+        try:
+            stat = os.stat(path)
+            # The modified time is when the image was stored, so it is what the TTL is measured against
+            if self.ttl_seconds and time.time() - stat.st_mtime > self.ttl_seconds:
+                self.remove(path, stat.st_size)
+                raise FileNotFoundError(path)
+            with open(path, "rb") as cacheFile:
+                data = cacheFile.read()
+            # The access time doubles as the "last used" time for LRU eviction
+            os.utime(path, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            return None
+
+        return io.BytesIO(data)
+
+    def put(self, key, data):
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tempPath = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tempPath, "wb") as cacheFile:
+            cacheFile.write(data)
+        # Storing the same key again replaces the old file, so only the difference in size is added
+        try:
+            replacedSize = os.stat(path).st_size
+        except FileNotFoundError:
+            replacedSize = 0
+        os.replace(tempPath, path)
+
+        with self.lock:
+            self.total_bytes += len(data) - replacedSize
+            overLimit = self.max_bytes and self.total_bytes > self.max_bytes
+        if overLimit:
+            self.evict()
+
+    def remove(self, path, size):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self.lock:
+            self.total_bytes -= size
+
+    def evict(self):
+        entries = sorted(((entry.stat(), entry.path) for entry in self.scan_entries()), key=lambda item: item[0].st_atime)
+        with self.lock:
+            self.total_bytes = sum(stat.st_size for stat, path in entries)
+        # Go a bit below the limit so the next few puts don't each trigger another scan
+        target = self.max_bytes * 0.9
+        for stat, path in entries:
+            if self.total_bytes <= target:
+                break
+            self.remove(path, stat.st_size)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes": self.total_bytes}
+
+
+def get_image_cache(folder, max_mb, ttl_hours):
+    global image_cache
+    
+    with image_cache_lock:
+        if image_cache is None or image_cache.folder != folder:
+            image_cache = ImageCache(folder, int(max_mb * 1024 * 1024), int(ttl_hours * 3600))
+        else:
+            image_cache.max_bytes = int(max_mb * 1024 * 1024)
+            image_cache.ttl_seconds = int(ttl_hours * 3600)
+    
+    return image_cache
+
+
+def cached_image_generation_request(apiKeys, image_prompt, platform, openai_api, stability_api=None, imageCache=None, clipdrop_session=None, retryPolicy=None, imageRouter=None):
+    if imageCache:
+        # A routed prompt may already have been drawn by any of the platforms
+        cacheKeys = {ImageCache.make_key(cachedPlatform, image_prompt): cachedPlatform for cachedPlatform in (imageRouter.platforms if imageRouter else [platform])}
+        cacheKey, virtual_image_file = imageCache.get_first(list(cacheKeys))
+        if virtual_image_file is not None:
+            return virtual_image_file, True, cacheKeys[cacheKey]
+
+    if imageRouter:
+        virtual_image_file, platform = imageRouter.request(apiKeys, image_prompt, openai_api, stability_api, clipdrop_session, retryPolicy)
+    else:
+        virtual_image_file = hedged_image_generation_request(apiKeys, image_prompt, platform, openai_api, stability_api, clipdrop_session, retryPolicy)
+    if imageCache:
+        # getvalue() hands back the buffer itself without copying when it is already the exact size
+        imageCache.put(ImageCache.make_key(platform, image_prompt), virtual_image_file.getvalue())
+
+    return virtual_image_file, False, platform
+
+
+def get_file_size(fileObj):
+    position = fileObj.tell()
+    size = fileObj.seek(0, io.SEEK_END)
+    fileObj.seek(position)
+    
+    return size
+
+
+def get_render_pool(workers):
+    global render_pool, render_pool_workers
+    
+    # The process pool is kept for the life of the process so repeated batches don't pay the worker startup cost again
+    with render_pool_lock:
+        if render_pool is None or render_pool_workers != workers:
+            if render_pool is not None:
+                render_pool.shutdown(wait=False)
+            # Loading multiprocessing costs import time that only pipeline runs need
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # Forking copies the locks other threads (web jobs, log writer, image requests) happen to hold, which can deadlock the worker.
+            # A forkserver starts workers from a clean single-threaded process instead. Windows only has spawn.
+            startMethod = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            render_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(startMethod))
+            render_pool_workers = workers
+    
+    return render_pool
+
+
+def shutdown_render_pool():
+    global render_pool
+    
+    # Let go of the pool while the interpreter is still whole, its cleanup callbacks fail once modules are being torn down
+    with render_pool_lock:
+        if render_pool is not None:
+            render_pool.shutdown()
+            render_pool = None
+
+
+def run_meme_pipeline(meme_count, text_stage, image_stage, render_stage, pipelineConfig, on_error=None):
+    textQueue = queue.Queue()
+    imageQueue = queue.Queue(maxsize=pipelineConfig.image_queue_depth)
+    renderQueue = queue.Queue(maxsize=pipelineConfig.render_queue_depth)
+    for i in range(meme_count):
+        textQueue.put(i)
+
+    results = [None] * meme_count
+    errors = {}
+    failed = threading.Event()
+    stop = object()
+
+    def record_error(i, ex):
+        # on_error decides whether the rest of the batch carries on without this meme
+        if on_error is not None and on_error(i, ex):
+            return
+        errors[i] = ex
+        failed.set()
+
+    def text_worker():
+        while not failed.is_set():
+            try:
+                i = textQueue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                imageQueue.put((i, text_stage(i)))
+            except Exception as ex:
+                record_error(i, ex)
+
+    def image_worker():
+        while True:
+            item = imageQueue.get()
+            if item is stop:
+                return
+            i, memeDict = item
+            # Keep draining after a failure so upstream workers never block on a full queue
+            if failed.is_set():
+                continue
+            try:
+                renderQueue.put((i, memeDict, image_stage(i, memeDict)))
+            except Exception as ex:
+                record_error(i, ex)
+
+    def render_worker():
+        while True:
+            item = renderQueue.get()
+            if item is stop:
+                return
+            i, memeDict, virtual_image_file = item
+            if failed.is_set():
+                continue
+            try:
+                results[i] = render_stage(i, memeDict, virtual_image_file)
+            except Exception as ex:
+                record_error(i, ex)
+
+    def start_workers(target, count):
+        threads = [threading.Thread(target=target, daemon=True) for _ in range(max(1, count))]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    textThreads = start_workers(text_worker, pipelineConfig.text_workers)
+    imageThreads = start_workers(image_worker, pipelineConfig.image_workers)
+    renderThreads = start_workers(render_worker, pipelineConfig.render_workers)
+
+    # Shut the stages down in order, so each one sees its stop markers only after the stage before it has finished
+    for thread in textThreads:
+        thread.join()
+    for _ in imageThreads:
+        imageQueue.put(stop)
+    for thread in imageThreads:
+        thread.join()
+    for _ in renderThreads:
+        renderQueue.put(stop)
+    for thread in renderThreads:
+        thread.join()
+
+    if errors:
+        raise errors[min(errors)]
+    
+    return results
+
+
+# generate() keyword arguments that settings.ini can set: (argument, setting, type to convert to)
+config_option_settings = [
+    ("text_model", "Text_Model", None),
+    ("temperature", "Temperature", float),
+    ("basic_instructions", "Basic_Instructions", None),
+    ("image_special_instructions", "Image_Special_Instructions", None),
+    ("image_platform", "Image_Platform", None),
+    ("font_file", "Font_File", None),
+    ("text_layout", "Text_Layout", None),
+    ("output_format", "Output_Format", None),
+    ("png_compress_level", "PNG_Compress_Level", int),
+    ("output_quality", "Output_Quality", int),
+    ("base_file_name", "Base_File_Name", None),
+    ("output_folder", "Output_Folder", None),
+    ("output_sharding", "Output_Sharding", None),
+    ("use_meme_index", "Use_Meme_Index", None),
+    ("log_max_mb", "Log_Max_MB", float),
+    ("log_backup_count", "Log_Backup_Count", int),
+    ("save_web_images", "Save_Web_Images", None),
+    ("web_image_width", "Web_Image_Width", int),
+    ("thumbnail_width", "Thumbnail_Width", int),
+    ("release_channel", "Release_Channel", None),
+    ("max_concurrent_memes", "Max_Concurrent_Memes", int),
+    ("use_pipeline", "Use_Pipeline", None),
+    ("use_image_cache", "Use_Image_Cache", None),
+    ("image_cache_folder", "Image_Cache_Folder", None),
+    ("image_cache_max_mb", "Image_Cache_Max_MB", float),
+    ("image_cache_ttl_hours", "Image_Cache_TTL_Hours", float),
+    ("use_caption_cache", "Use_Caption_Cache", None),
+    ("caption_cache_pool_size", "Caption_Cache_Pool_Size", int),
+    ("caption_cache_max_prompts", "Caption_Cache_Max_Prompts", int),
+    ("caption_cache_reuse_ratio", "Caption_Cache_Reuse_Ratio", float),
+    ("text_batch_mode", "Text_Batch_Mode", None),
+    ("api_max_connections", "API_Max_Connections", int),
+]
+
+
+def get_config_options(settings):
+    # The generate() keyword arguments set in settings.ini, for generate() and agenerate() alike
+    options = {}
+    for name, key, cast in config_option_settings:
+        if key in settings:
+            options[name] = cast(settings[key]) if cast else settings[key]
+    
+    options["image_retry_policy"] = ImageRetryPolicyTupleClass(
+        {
+            "openai": float(settings.get('OpenAI_Image_Timeout', 120)),
+            "stability": float(settings.get('Stability_Image_Timeout', 120)),
+            "clipdrop": float(settings.get('ClipDrop_Image_Timeout', 60)),
+        },
+        int(settings.get('Image_Max_Retries', 3)),
+        float(settings.get('Image_Retry_Backoff', 1.0)),
+        float(settings.get('Image_Retry_Backoff_Max', 30)),
+        settings.get('Use_Hedged_Requests', False),
+        float(settings.get('Hedge_Percentile', 95)),
+    )
+    options["image_router_config"] = ImageRouterConfigTupleClass(
+        settings.get('Image_Routing', 'weighted_round_robin'),
+        parse_platform_values(settings.get('Image_Platform_Weights', '')),
+        parse_platform_values(settings.get('Image_Platform_Max_Concurrent', ''), int),
+        float(settings.get('Image_Platform_Cooldown', 30)),
+    )
+    options["rate_limits"] = RateLimitConfigTupleClass(
+        parse_platform_values(settings.get('Requests_Per_Minute', '')),
+        parse_platform_values(settings.get('Tokens_Per_Minute', '')),
+        settings.get('Rate_Limit_Folder', ''),
+    )
+    options["conversation_policy"] = ConversationPolicyTupleClass(
+        settings.get('Conversation_Mode', 'sliding_window'),
+        int(settings.get('Conversation_Window', 4)),
+        int(settings.get('Conversation_Token_Budget', 2000)),
+    )
+    options["pipeline_config"] = PipelineConfigTupleClass(
+        int(settings.get('Pipeline_Text_Workers', 2)),
+        int(settings.get('Pipeline_Image_Workers', 4)),
+        int(settings.get('Pipeline_Render_Workers', 2)),
+        # Settings files from before the two queues had their own depths have a single Pipeline_Queue_Depth
+        int(settings.get('Pipeline_Image_Queue_Depth', settings.get('Pipeline_Queue_Depth', 4))),
+        int(settings.get('Pipeline_Render_Queue_Depth', settings.get('Pipeline_Queue_Depth', 4))),
+    )
+    
+    return options
+
+
+def take_ready_caption(i, batchedMemeDicts, captionCache=None, captionKey=None):
+    # A caption from the batch request, or else one reused from the caption cache. (None, False) means the chat bot has to write one.
+    if i < len(batchedMemeDicts):
+        memeDict = dict(batchedMemeDicts[i])
+        if captionCache:
+            captionCache.add(captionKey, memeDict)
+        return memeDict, False
+    
+    memeDict = captionCache.sample(captionKey) if captionCache else None
+    return memeDict, memeDict is not None
+
+
+# The bookkeeping after each stage of a meme, shared by generate() and agenerate(). Each returns the data for the stage's event.
+def record_caption_stage(stats, stageStart, memeDict, cacheHit, captionCache=None):
+    stats["timings"]["text"] = time.perf_counter() - stageStart
+    stats["caption_cache_hit"] = cacheHit
+    metrics.observe("meme_stage_seconds", stats["timings"]["text"], stage="text")
+    if captionCache:
+        metrics.inc("cache_hits_total" if cacheHit else "cache_misses_total", cache="caption")
+    
+    return {"meme_text": memeDict['meme_text'], "image_prompt": memeDict['image_prompt'], "cache_hit": cacheHit}
+
+
+def record_image_stage(stats, stageStart, virtual_image_file, cacheHit, platform, imageCache=None):
+    stats["timings"]["image"] = time.perf_counter() - stageStart
+    stats["image_cache_hit"] = cacheHit
+    stats["image_bytes"] = get_file_size(virtual_image_file)
+    stats["platform"] = platform
+    metrics.observe("meme_stage_seconds", stats["timings"]["image"], stage="image")
+    if not cacheHit:
+        metrics.observe("image_request_seconds", stats["timings"]["image"], platform=platform)
+    if imageCache:
+        metrics.inc("cache_hits_total" if cacheHit else "cache_misses_total", cache="image")
+    
+    return {"platform": platform, "bytes": stats["image_bytes"], "cache_hit": cacheHit}
+
+
+def record_rendered_meme(stats, stageStart, renderTimings, memeDict, fileName, filePath, virtualMemeFile, logContext, generationLog, memeStore=None, noFileSave=False):
+    stats["timings"]["render"] = time.perf_counter() - stageStart
+    # CPU time isn't a stage of its own, so it is kept out of the timings
+    renderTimings = dict(renderTimings)
+    renderCpu = renderTimings.pop("cpu", None)
+    if renderCpu is not None:
+        metrics.observe("render_cpu_seconds", renderCpu)
+    stats["timings"].update(renderTimings)
+    stats["timings"]["total"] = time.perf_counter() - stats["started"]
+    for stage in ("render", "compose", "encode", "write", "derivatives", "total"):
+        if stage in stats["timings"]:
+            metrics.observe("meme_stage_seconds", stats["timings"][stage], stage=stage)
+    metrics.inc("memes_generated_total", platform=stats["platform"])
+    
+    if not noFileSave:
+        generationLog.write({
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "file_name": fileName,
+            "user_prompt": logContext["user_prompt"],
+            "basic_instructions": logContext["basic_instructions"],
+            "image_special_instructions": logContext["image_special_instructions"],
+            "meme_text": memeDict['meme_text'],
+            "image_prompt": memeDict['image_prompt'],
+            "text_model": logContext["text_model"],
+            "platform": stats["platform"],
+            "timings": {stage: round(seconds, 4) for stage, seconds in stats["timings"].items()},
+            "image_bytes": stats["image_bytes"],
+            "meme_bytes": get_file_size(virtualMemeFile),
+            "caption_cache_hit": stats["caption_cache_hit"],
+            "image_cache_hit": stats["image_cache_hit"],
+        })
+        if memeStore:
+            memeStore.add(fileName, filePath, logContext["user_prompt"], memeDict, stats["platform"], get_file_size(virtualMemeFile))
+    
+    return {"meme_text": memeDict['meme_text'], "image_prompt": memeDict['image_prompt'], "file_path": os.path.abspath(filePath), "virtual_meme_file": virtualMemeFile, "file_name": fileName}
+
+
 def generate(
     text_model="gpt-4",
     temperature=1.0,
@@ -483,50 +2342,171 @@ def generate(
     clipdrop_key=None,
     noUserInput=False,
     noFileSave=False,
-    release_channel="all"
+    release_channel="all",
+    max_concurrent_memes=1,
+    use_pipeline=False,
+    pipeline_config=None,
+    event_callback=None,
+    use_image_cache=False,
+    image_cache_folder="Image_Cache",
+    image_cache_max_mb=500,
+    image_cache_ttl_hours=168,
+    use_caption_cache=False,
+    caption_cache_pool_size=8,
+    caption_cache_max_prompts=1000,
+    caption_cache_reuse_ratio=0.5,
+    text_batch_mode="off",
+    conversation_policy=None,
+    api_max_connections=20,
+    text_layout="exact",
+    output_format="png",
+    png_compress_level=6,
+    output_quality=90,
+    output_sharding="date",
+    use_meme_index=True,
+    log_max_mb=10,
+    log_backup_count=5,
+    save_web_images=True,
+    web_image_width=1024,
+    thumbnail_width=160,
+    image_retry_policy=None,
+    image_router_config=None,
+    rate_limits=None,
+    headless=False,
+    args=None
 ):
     
+    # headless is for servers and other programs calling in: it never asks for input, clears the screen or exits the process.
+    # Errors are raised as MemeGenerationError subclasses instead, and memes that fail are left out of the results and listed in their .errors.
+    if headless:
+        noUserInput = True
     
-    settings = get_settings()
-    use_config = settings.get('Use_This_Config', False) 
-    if use_config:
-        text_model = settings.get('Text_Model', text_model)
-        temperature = float(settings.get('Temperature', temperature))
-        basic_instructions = settings.get('Basic_Instructions', basic_instructions)
-        image_special_instructions = settings.get('Image_Special_Instructions', image_special_instructions)
-        image_platform = settings.get('Image_Platform', image_platform)
-        font_file = settings.get('Font_File', font_file)
-        base_file_name = settings.get('Base_File_Name', base_file_name)
-        output_folder = settings.get('Output_Folder', output_folder)
-        release_channel = settings.get('Release_Channel', release_channel)
+    def handle_generation_error(ex):
+        # Interactive runs show the error and exit, headless ones raise it as a MemeGenerationError
+        if headless:
+            raise to_meme_generation_error(ex, text_model)
+    
+        if isinstance(ex, (MissingOpenAIKeyError, MissingAPIKeyError)):
+            print(f"\n  ERROR:  {ex}")
+        # openai.NotFoundError, checked without importing openai just for this except clause
+        elif is_module_error(ex, "openai", "NotFoundError"):
+            print(f"\n  ERROR:  {ex}")
+            if "The model" in str(ex) and "does not exist" in str(ex):
+                #if 'gpt-4' in str(irx):
+                if str(ex) == "The model `gpt-4` does not exist":
+                    print("  (!) Note: This error actually means you do not have access to the GPT-4 model yet.")
+                    print("  (!)       - You can see more about the current GPT-4 requirements here: https://help.openai.com/en/articles/7102672-how-can-i-access-gpt-4")
+                    print("  (!)       - Also ensure your country is supported: https://platform.openai.com/docs/supported-countries")
+                    print("  (!)       - You can try the 'gpt-3.5-turbo' model instead. See more here: https://platform.openai.com/docs/models/overview)")
+                else:
+                    print("   > Either the model name is incorrect, or you do not have access to it.")
+                    print("   > See this page to see the model names to use in the API: https://platform.openai.com/docs/models/overview")
+        else:
+            traceback.print_exc()
+            print(f"\n  ERROR:  An error occurred while generating the meme. Error: {ex}")
+        if not noUserInput:
+            input("\nPress Enter to exit...")
+        sys.exit()
+
+    # Setup errors, such as a missing key or an output folder that can't be written to, are handled like any other
+    try:
+        settings = get_settings(headless=headless)
+        use_config = settings.get('Use_This_Config', False) 
+        if use_config:
+            configured = get_config_options(settings)
+            text_model = configured.get('text_model', text_model)
+            temperature = configured.get('temperature', temperature)
+            basic_instructions = configured.get('basic_instructions', basic_instructions)
+            image_special_instructions = configured.get('image_special_instructions', image_special_instructions)
+            image_platform = configured.get('image_platform', image_platform)
+            font_file = configured.get('font_file', font_file)
+            text_layout = configured.get('text_layout', text_layout)
+            output_format = configured.get('output_format', output_format)
+            png_compress_level = configured.get('png_compress_level', png_compress_level)
+            output_quality = configured.get('output_quality', output_quality)
+            base_file_name = configured.get('base_file_name', base_file_name)
+            output_folder = configured.get('output_folder', output_folder)
+            output_sharding = configured.get('output_sharding', output_sharding)
+            use_meme_index = configured.get('use_meme_index', use_meme_index)
+            log_max_mb = configured.get('log_max_mb', log_max_mb)
+            log_backup_count = configured.get('log_backup_count', log_backup_count)
+            save_web_images = configured.get('save_web_images', save_web_images)
+            web_image_width = configured.get('web_image_width', web_image_width)
+            thumbnail_width = configured.get('thumbnail_width', thumbnail_width)
+            release_channel = configured.get('release_channel', release_channel)
+            max_concurrent_memes = configured.get('max_concurrent_memes', max_concurrent_memes)
+            use_pipeline = configured.get('use_pipeline', use_pipeline)
+            use_image_cache = configured.get('use_image_cache', use_image_cache)
+            image_cache_folder = configured.get('image_cache_folder', image_cache_folder)
+            image_cache_max_mb = configured.get('image_cache_max_mb', image_cache_max_mb)
+            image_cache_ttl_hours = configured.get('image_cache_ttl_hours', image_cache_ttl_hours)
+            use_caption_cache = configured.get('use_caption_cache', use_caption_cache)
+            caption_cache_pool_size = configured.get('caption_cache_pool_size', caption_cache_pool_size)
+            caption_cache_max_prompts = configured.get('caption_cache_max_prompts', caption_cache_max_prompts)
+            caption_cache_reuse_ratio = configured.get('caption_cache_reuse_ratio', caption_cache_reuse_ratio)
+            text_batch_mode = configured.get('text_batch_mode', text_batch_mode)
+            api_max_connections = configured.get('api_max_connections', api_max_connections)
+            image_retry_policy = configured['image_retry_policy']
+            image_router_config = configured['image_router_config']
+            rate_limits = configured['rate_limits']
+            conversation_policy = configured['conversation_policy']
+            pipeline_config = configured['pipeline_config']
     
    
-    args = parser.parse_args()
+        # Command line arguments only come in through the CLI entry point, everyone else gets the defaults
+        if args is None:
+            args = build_arg_parser().parse_args([])
 
    
-    if not openai_key:
-        apiKeys = get_api_keys(args=args)
-    else:
-        apiKeys = ApiKeysTupleClass(openai_key, clipdrop_key, stability_key)
+        if not openai_key:
+            apiKeys = get_api_keys(args=args, headless=headless)
+        else:
+            apiKeys = ApiKeysTupleClass(openai_key, clipdrop_key, stability_key)
         
     
-    validate_api_keys(apiKeys, image_platform)
+        validate_api_keys(apiKeys, image_platform)
    
-    stability_api, openai_api = initialize_api_clients(apiKeys, image_platform)
-
-    
-    if args.imageplatform:
-        image_platform = args.imageplatform
-    if args.temperature:
-        temperature = float(args.temperature)
-    if args.basicinstructions:
-        basic_instructions = args.basicinstructions
-    if args.imagespecialinstructions:
-        image_special_instructions = args.imagespecialinstructions
-    if args.nofilesave:
-        noFileSave=True
-    if args.nouserinput:
-        noUserInput=True
+        stability_api, openai_api, clipdrop_session = get_api_clients(apiKeys, image_platform, api_max_connections)
+
+    
+        if args.imageplatform:
+            image_platform = args.imageplatform
+        if args.temperature:
+            temperature = float(args.temperature)
+        if args.basicinstructions:
+            basic_instructions = args.basicinstructions
+        if args.imagespecialinstructions:
+            image_special_instructions = args.imagespecialinstructions
+        if args.nofilesave:
+            noFileSave=True
+        if args.nouserinput:
+            noUserInput=True
+        if args.maxconcurrent:
+            max_concurrent_memes = int(args.maxconcurrent)
+        if args.pipeline:
+            use_pipeline = True
+        if not pipeline_config:
+            pipeline_config = default_pipeline_config
+        if not conversation_policy:
+            conversation_policy = default_conversation_policy
+        if not image_retry_policy:
+            image_retry_policy = default_image_retry_policy
+        if not image_router_config:
+            image_router_config = default_image_router_config
+        if rate_limits:
+            set_rate_limits(rate_limits)
+
+        generationLog = get_generation_log(output_folder, log_max_mb, log_backup_count)
+        memeStats = {}
+        memeErrors = {}
+        memeStore = get_meme_store(output_folder) if use_meme_index and not noFileSave else None
+        output_sharding = get_output_sharding(output_sharding, use_meme_index)
+        renderOptions = {"output_format": output_format, "compress_level": png_compress_level, "quality": output_quality, "derivative_widths": {"web": web_image_width, "thumb": thumbnail_width} if save_web_images else None}
+        imageRouter = get_image_router(apiKeys, image_router_config) if image_platform.lower() == "auto" else None
+        imageCache = get_image_cache(image_cache_folder, image_cache_max_mb, image_cache_ttl_hours) if use_image_cache else None
+        captionCache = get_caption_cache(caption_cache_pool_size, caption_cache_max_prompts, caption_cache_reuse_ratio) if use_caption_cache else None
+    except Exception as ex:
+        handle_generation_error(ex)
 
     systemPrompt = construct_system_prompt(basic_instructions, image_special_instructions)
     conversation = [{"role": "system", "content": systemPrompt}]
@@ -535,13 +2515,16 @@ def generate(
     try:
         font_file = check_font(font_file)
     except NoFontFileError as fx:
+        if headless:
+            raise
         print(f"\n  ERROR:  {fx}")
         if not noUserInput:
             input("\nPress Enter to exit...")
         sys.exit()
                 
     
-    os.system('cls' if os.name == 'nt' else 'clear')
+    if not headless:
+        os.system('cls' if os.name == 'nt' else 'clear')
 
    
     print(f"\n==================== AI Meme Generator - {version} ====================")
@@ -574,92 +2557,333 @@ def generate(
             
     
 
-    def single_meme_generation_loop():
-        
-        chatResponse = send_and_receive_message(openai_api, text_model, userEnteredPrompt, conversation, temperature)
+    logContext = {"user_prompt": userEnteredPrompt, "basic_instructions": basic_instructions, "image_special_instructions": image_special_instructions, "text_model": text_model}
 
-       
-        memeDict = parse_meme(chatResponse)
-        image_prompt = memeDict['image_prompt']
-        meme_text = memeDict['meme_text']
+    def emit_event(event, i, data=None):
+        # Lets callers such as the web app follow each meme through the stages, rather than waiting for the whole batch
+        if event_callback:
+            event_callback(event, i, data or {})
 
+    def generate_meme_text(i, conversationTemp):
+        emit_event("meme_started", i)
+        memeStats[i] = {"started": time.perf_counter(), "timings": {}}
+        stageStart = time.perf_counter()
+        
+        captionKey = CaptionCache.make_key(text_model, systemPrompt, userEnteredPrompt, temperature) if captionCache else None
+        memeDict, cacheHit = take_ready_caption(i, batchedMemeDicts, captionCache, captionKey)
         
-        print("\n   Meme Text:  " + meme_text)
-        print("   Image Prompt:  " + image_prompt)
+        if memeDict is None:
+            chatResponse = send_and_receive_message(openai_api, text_model, userEnteredPrompt, conversationTemp, temperature, conversation_policy)
+
+           
+            memeDict = parse_meme_reply(chatResponse)
+            if captionCache:
+                captionCache.add(captionKey, memeDict)
 
         
+        print("\n   Meme Text:  " + memeDict['meme_text'])
+        print("   Image Prompt:  " + memeDict['image_prompt'])
+        emit_event("caption_ready", i, record_caption_stage(memeStats[i], stageStart, memeDict, cacheHit, captionCache))
+
+        return memeDict
+
+    def generate_meme_image(i, memeDict):
         print("\nSending image creation request...")
-        virtual_image_file = image_generation_request(apiKeys, image_prompt, image_platform, openai_api, stability_api)
+        stageStart = time.perf_counter()
+        virtual_image_file, cacheHit, platform = cached_image_generation_request(apiKeys, memeDict['image_prompt'], image_platform, openai_api, stability_api, imageCache, clipdrop_session, image_retry_policy, imageRouter)
+        if cacheHit:
+            print("   (Image loaded from cache)")
+        emit_event("image_received", i, record_image_stage(memeStats[i], stageStart, virtual_image_file, cacheHit, platform, imageCache))
+        
+        return virtual_image_file
 
+    def render_meme(i, memeDict, virtual_image_file, renderPool=None):
+        meme_text = memeDict['meme_text']
+        stageStart = time.perf_counter()
         
-        filePath,fileName = set_file_path(base_file_name, output_folder)
-        virtualMemeFile = create_meme(virtual_image_file, meme_text, filePath, noFileSave=noFileSave,fontFile=font_file)
-        if not noFileSave:
-            
-            write_log_file(userEnteredPrompt, memeDict, filePath, output_folder, basic_instructions, image_special_instructions, image_platform)
+        filePath,fileName = reserve_file_path(base_file_name, output_folder, noFileSave=noFileSave, extension=get_output_extension(output_format), sharding=output_sharding)
+        try:
+            if renderPool:
+                virtualMemeFile, renderTimings = renderPool.submit(render_meme_file, virtual_image_file, meme_text, filePath, noFileSave=noFileSave, fontFile=font_file, text_layout=text_layout, **renderOptions).result()
+            else:
+                virtualMemeFile, renderTimings = render_meme_file(virtual_image_file, meme_text, filePath, noFileSave=noFileSave,fontFile=font_file, text_layout=text_layout, **renderOptions)
+        except Exception:
+            if not noFileSave and os.path.isfile(filePath):
+                os.remove(filePath)
+            raise
+        
+        memeInfoDict = record_rendered_meme(memeStats[i], stageStart, renderTimings, memeDict, fileName, filePath, virtualMemeFile, logContext, generationLog, memeStore, noFileSave)
+        emit_event("render_done", i, memeInfoDict)
+        
+        return memeInfoDict
+
+    def run_stage(stage, function, *args):
+        try:
+            return function(*args)
+        except Exception:
+            metrics.inc("meme_errors_total", stage=stage)
+            raise
+
+    def skip_failed_meme(i, ex):
+        # One meme failing doesn't throw the others away, unless every other meme would fail the same way
+        if is_batch_fatal_error(ex):
+            return False
+        memeErrors[i] = to_meme_generation_error(ex, text_model)
+        print(f"\n  ERROR:  Meme {i+1} failed and was skipped. Error: {str(ex) or type(ex).__name__}")
+        emit_event("meme_failed", i, {"error": str(ex) or type(ex).__name__})
         
-        absoluteFilePath = os.path.abspath(filePath)
+        return True
+
+    def single_meme_generation_loop(i, conversationTemp):
+        memeDict = run_stage("text", generate_meme_text, i, conversationTemp)
+        virtual_image_file = run_stage("image", generate_meme_image, i, memeDict)
         
-        return {"meme_text": meme_text, "image_prompt": image_prompt, "file_path": absoluteFilePath, "virtual_meme_file": virtualMemeFile, "file_name": fileName}
+        return run_stage("render", render_meme, i, memeDict, virtual_image_file)
     
+    def concurrent_meme_generation_loop(i):
+        print(f"Generating meme {i+1} of {meme_count}...")
+        # Each in-flight meme gets its own copy of the conversation so the requests don't see each other's messages
+        try:
+            return single_meme_generation_loop(i, list(conversation))
+        except Exception as ex:
+            if not skip_failed_meme(i, ex):
+                raise
+
+    def pipeline_text_stage(i):
+        print(f"Generating meme {i+1} of {meme_count}...")
+        return run_stage("text", generate_meme_text, i, list(conversation))
+
+    def pipeline_image_stage(i, memeDict):
+        return run_stage("image", generate_meme_image, i, memeDict)
+
+    def pipeline_render_stage(i, memeDict, virtual_image_file):
+        renderPool = get_render_pool(pipeline_config.render_workers) if pipeline_config.render_workers > 0 else None
+        return run_stage("render", render_meme, i, memeDict, virtual_image_file, renderPool)
   
     memeResultsDictsList = []
 
    
     try:
         
-        for i in range(meme_count):
+        batchedMemeDicts = []
+        if text_batch_mode in ("prompt", "choices") and meme_count > 1:
             print("\n----------------------------------------------------------------------------------------------------")
-            print(f"Generating meme {i+1} of {meme_count}...")
-            memeInfoDict = single_meme_generation_loop()
-
-           
-            memeResultsDictsList.append(memeInfoDict)
+            # Any memes the reply came up short on are written one at a time by generate_meme_text()
+            batchedMemeDicts = send_and_receive_batch_message(openai_api, text_model, userEnteredPrompt, list(conversation), meme_count, temperature, text_batch_mode, conversation_policy)
+        
+        if use_pipeline and meme_count > 1:
+            print("\n----------------------------------------------------------------------------------------------------")
+            print(f"Generating {meme_count} memes through the pipeline ({pipeline_config.text_workers} text / {pipeline_config.image_workers} image / {pipeline_config.render_workers} render workers)...")
+            memeResultsDictsList = run_meme_pipeline(meme_count, pipeline_text_stage, pipeline_image_stage, pipeline_render_stage, pipeline_config, on_error=skip_failed_meme)
+        elif max_concurrent_memes > 1 and meme_count > 1:
+            print("\n----------------------------------------------------------------------------------------------------")
+            print(f"Generating {meme_count} memes, up to {max_concurrent_memes} at a time...")
+            with ThreadPoolExecutor(max_workers=min(max_concurrent_memes, meme_count)) as executor:
+                # map() yields in submission order, so the results line up with the sequential mode
+                memeResultsDictsList = list(executor.map(concurrent_meme_generation_loop, range(meme_count)))
+        else:
+            for i in range(meme_count):
+                print("\n----------------------------------------------------------------------------------------------------")
+                print(f"Generating meme {i+1} of {meme_count}...")
+                try:
+                    memeInfoDict = single_meme_generation_loop(i, conversation)
+                except Exception as ex:
+                    if not skip_failed_meme(i, ex):
+                        raise
+                    continue
+
+               
+                memeResultsDictsList.append(memeInfoDict)
+        
+        memeResultsDictsList = MemeResultsList([memeInfoDict for memeInfoDict in memeResultsDictsList if memeInfoDict is not None], memeErrors)
+        if memeErrors and not memeResultsDictsList:
+            if headless:
+                raise MemeBatchError("Every meme failed.", memeErrors)
+            raise memeErrors[min(memeErrors)]
             
         
+        generationLog.flush()
         print("\n\nFinished. Output directory: " + os.path.abspath(output_folder))
+        if memeErrors:
+            print(f"{len(memeErrors)} of {meme_count} memes failed and were skipped.")
+        if not headless:
+            # Servers read the same numbers from /metrics, instead of every job printing the whole process's table
+            print("\nTimings and counts so far:\n" + metrics.summary())
+        if imageCache:
+            cacheStats = imageCache.stats()
+            print(f"Image cache: {cacheStats['hits']} hits, {cacheStats['misses']} misses, {cacheStats['bytes'] / (1024 * 1024):.1f} MB stored")
+        if captionCache:
+            cacheStats = captionCache.stats()
+            print(f"Caption cache: {cacheStats['hits']} hits, {cacheStats['misses']} misses, {cacheStats['prompts']} prompts stored")
         if not noUserInput:
             input("\nPress Enter to exit...")
     
-    except MissingOpenAIKeyError as ox:
-        print(f"\n  ERROR:  {ox}")
-        if not noUserInput:
-            input("\nPress Enter to exit...")
-        sys.exit()
+    except Exception as ex:
+        handle_generation_error(ex)
+    
+  
+    return memeResultsDictsList
+
+async def agenerate(**kwargs):
+    import asyncio
+    import inspect
+    
+    # Takes the same keyword arguments as generate() and reads settings.ini the same way, but always runs like generate(headless=True).
+    # Text and images are requested with async clients, so one event loop can have many memes in flight without a thread for each.
+    # Rendering runs in the render pool (or a worker thread with Pipeline_Render_Workers = 0), and Image_Platform = auto runs the threaded router in a worker thread.
+    options = {name: parameter.default for name, parameter in inspect.signature(generate).parameters.items()}
+    unknownOptions = set(kwargs) - set(options)
+    if unknownOptions:
+        raise TypeError(f"agenerate() got unexpected keyword arguments: {', '.join(sorted(unknownOptions))}")
+    options.update(kwargs)
+    
+    try:
+        settings = get_settings(headless=True)
+        if settings.get('Use_This_Config', False):
+            options.update(get_config_options(settings))
+    
+        meme_count = options["meme_count"]
+        image_platform = options["image_platform"]
+        output_folder = options["output_folder"]
+        noFileSave = options["noFileSave"]
+        event_callback = options["event_callback"]
+        userEnteredPrompt = options["user_entered_prompt"]
+        pipeline_config = options["pipeline_config"] or default_pipeline_config
+        conversation_policy = options["conversation_policy"] or default_conversation_policy
+        image_retry_policy = options["image_retry_policy"] or default_image_retry_policy
+        if options["rate_limits"]:
+            set_rate_limits(options["rate_limits"])
+    
+        if options["openai_key"]:
+            apiKeys = ApiKeysTupleClass(options["openai_key"], options["clipdrop_key"], options["stability_key"])
+        else:
+            apiKeys = get_api_keys(args=options["args"] or build_arg_parser().parse_args([]), headless=True)
+        validate_api_keys(apiKeys, image_platform)
+        font_file = check_font(options["font_file"])
+    
+        async_openai, clipdrop_client = get_async_api_clients(apiKeys, options["api_max_connections"])
+        stability_api, openai_api, clipdrop_session = get_api_clients(apiKeys, image_platform, options["api_max_connections"]) if image_platform in ("stability", "auto") else (None, None, None)
+        imageRouter = get_image_router(apiKeys, options["image_router_config"] or default_image_router_config) if image_platform == "auto" else None
+        imageCache = get_image_cache(options["image_cache_folder"], options["image_cache_max_mb"], options["image_cache_ttl_hours"]) if options["use_image_cache"] else None
+        captionCache = get_caption_cache(options["caption_cache_pool_size"], options["caption_cache_max_prompts"], options["caption_cache_reuse_ratio"]) if options["use_caption_cache"] else None
+        generationLog = get_generation_log(output_folder, options["log_max_mb"], options["log_backup_count"])
+        memeStore = get_meme_store(output_folder) if options["use_meme_index"] and not noFileSave else None
+        options["output_sharding"] = get_output_sharding(options["output_sharding"], options["use_meme_index"])
+        renderPool = get_render_pool(pipeline_config.render_workers) if pipeline_config.render_workers > 0 else None
+    except Exception as ex:
+        raise to_meme_generation_error(ex, options["text_model"])
+    
+    renderOptions = {"output_format": options["output_format"], "compress_level": options["png_compress_level"], "quality": options["output_quality"], "derivative_widths": {"web": options["web_image_width"], "thumb": options["thumbnail_width"]} if options["save_web_images"] else None}
+    
+    systemPrompt = construct_system_prompt(options["basic_instructions"], options["image_special_instructions"])
+    conversation = [{"role": "system", "content": systemPrompt}]
+    logContext = {"user_prompt": userEnteredPrompt, "basic_instructions": options["basic_instructions"], "image_special_instructions": options["image_special_instructions"], "text_model": options["text_model"]}
+    # max_concurrent_memes still caps how many memes are in flight, but costs no threads here
+    inFlight = asyncio.Semaphore(max(1, options["max_concurrent_memes"]))
+    loop = asyncio.get_running_loop()
+    memeErrors = {}
+    
+    def emit_event(event, i, data=None):
+        if event_callback:
+            event_callback(event, i, data or {})
+    
+    async def generate_meme_text(i, stats):
+        stageStart = time.perf_counter()
+        captionKey = CaptionCache.make_key(options["text_model"], systemPrompt, userEnteredPrompt, options["temperature"]) if captionCache else None
+        memeDict, cacheHit = take_ready_caption(i, batchedMemeDicts, captionCache, captionKey)
+        if memeDict is None:
+            chatResponse = await async_send_and_receive_message(async_openai, options["text_model"], userEnteredPrompt, list(conversation), options["temperature"], conversation_policy)
+            memeDict = parse_meme_reply(chatResponse)
+            if captionCache:
+                captionCache.add(captionKey, memeDict)
         
-    except MissingAPIKeyError as ax:
-        print(f"\n  ERROR:  {ax}")
-        if not noUserInput:
-            input("\nPress Enter to exit...")
-        sys.exit()
+        emit_event("caption_ready", i, record_caption_stage(stats, stageStart, memeDict, cacheHit, captionCache))
         
- 
-    except openai.NotFoundError as nfx:
-        print(f"\n  ERROR:  {nfx}")
-        if "The model" in str(nfx) and "does not exist" in str(nfx):
-            #if 'gpt-4' in str(irx):
-            if str(nfx) == "The model `gpt-4` does not exist":
-                print("  (!) Note: This error actually means you do not have access to the GPT-4 model yet.")
-                print("  (!)       - You can see more about the current GPT-4 requirements here: https://help.openai.com/en/articles/7102672-how-can-i-access-gpt-4")
-                print("  (!)       - Also ensure your country is supported: https://platform.openai.com/docs/supported-countries")
-                print("  (!)       - You can try the 'gpt-3.5-turbo' model instead. See more here: https://platform.openai.com/docs/models/overview)")
-            else:
-                print("   > Either the model name is incorrect, or you do not have access to it.")
-                print("   > See this page to see the model names to use in the API: https://platform.openai.com/docs/models/overview")
-        if not noUserInput:
-            input("\nPress Enter to exit...")
-        sys.exit()
+        return memeDict
     
-    except Exception as ex:
+    async def generate_meme_image(i, stats, memeDict):
+        stageStart = time.perf_counter()
+        platform = image_platform
+        if imageRouter:
+            virtual_image_file, cacheHit, platform = await loop.run_in_executor(None, functools.partial(cached_image_generation_request, apiKeys, memeDict['image_prompt'], image_platform, openai_api, stability_api, imageCache, clipdrop_session, image_retry_policy, imageRouter))
+        else:
+            cacheKey = ImageCache.make_key(platform, memeDict['image_prompt'])
+            virtual_image_file = await asyncio.to_thread(imageCache.get, cacheKey) if imageCache else None
+            cacheHit = virtual_image_file is not None
+            if not cacheHit:
+                virtual_image_file = await async_hedged_image_generation_request(apiKeys, memeDict['image_prompt'], platform, async_openai, stability_api, clipdrop_client, image_retry_policy)
+                if imageCache:
+                    await asyncio.to_thread(imageCache.put, cacheKey, virtual_image_file.getvalue())
         
-        traceback.print_exc()
-        print(f"\n  ERROR:  An error occurred while generating the meme. Error: {ex}")
-        if not noUserInput:
-            input("\nPress Enter to exit...")
-        sys.exit()
+        emit_event("image_received", i, record_image_stage(stats, stageStart, virtual_image_file, cacheHit, platform, imageCache))
+        
+        return virtual_image_file
+    
+    async def render_meme(i, stats, memeDict, virtual_image_file):
+        stageStart = time.perf_counter()
+        filePath, fileName = reserve_file_path(options["base_file_name"], output_folder, noFileSave=noFileSave, extension=get_output_extension(options["output_format"]), sharding=options["output_sharding"])
+        try:
+            virtualMemeFile, renderTimings = await loop.run_in_executor(renderPool, functools.partial(render_meme_file, virtual_image_file, memeDict['meme_text'], filePath, font_file, noFileSave=noFileSave, text_layout=options["text_layout"], **renderOptions))
+        # Also when the meme is cancelled, so the reserved name isn't left behind as an empty file
+        except BaseException:
+            if not noFileSave and os.path.isfile(filePath):
+                os.remove(filePath)
+            raise
+        
+        # The log and the index are written to disk, so they are kept off the event loop
+        memeInfoDict = await asyncio.to_thread(record_rendered_meme, stats, stageStart, renderTimings, memeDict, fileName, filePath, virtualMemeFile, logContext, generationLog, memeStore, noFileSave)
+        emit_event("render_done", i, memeInfoDict)
+        
+        return memeInfoDict
+    
+    async def make_meme(i):
+        async with inFlight:
+            emit_event("meme_started", i)
+            stats = {"started": time.perf_counter(), "timings": {}}
+            stage = "text"
+            try:
+                memeDict = await generate_meme_text(i, stats)
+                stage = "image"
+                virtual_image_file = await generate_meme_image(i, stats, memeDict)
+                stage = "render"
+                return await render_meme(i, stats, memeDict, virtual_image_file)
+            except Exception as ex:
+                metrics.inc("meme_errors_total", stage=stage)
+                if is_batch_fatal_error(ex):
+                    raise
+                memeErrors[i] = to_meme_generation_error(ex, options["text_model"])
+                print(f"\n  ERROR:  Meme {i+1} failed and was skipped. Error: {str(ex) or type(ex).__name__}")
+                emit_event("meme_failed", i, {"error": str(ex) or type(ex).__name__})
+                return None
+    
+    batchedMemeDicts = []
+    memeTasks = []
+    try:
+        if options["text_batch_mode"] in ("prompt", "choices") and meme_count > 1:
+            # Any memes the reply came up short on are written one at a time by generate_meme_text()
+            batchedMemeDicts = await async_send_and_receive_batch_message(async_openai, options["text_model"], userEnteredPrompt, list(conversation), meme_count, options["temperature"], options["text_batch_mode"], conversation_policy)
+        memeTasks = [asyncio.ensure_future(make_meme(i)) for i in range(meme_count)]
+        memeResults = await asyncio.gather(*memeTasks)
+    except Exception as ex:
+        # The rest of the batch is thrown away, so it's stopped rather than left calling the APIs and writing files for a failed batch
+        for task in memeTasks:
+            task.cancel()
+        await asyncio.gather(*memeTasks, return_exceptions=True)
+        raise to_meme_generation_error(ex, options["text_model"])
+    await asyncio.to_thread(generationLog.flush)
+    
+    memeResultsDictsList = MemeResultsList([memeInfoDict for memeInfoDict in memeResults if memeInfoDict is not None], memeErrors)
+    if memeErrors and not memeResultsDictsList:
+        raise MemeBatchError("Every meme failed.", memeErrors)
     
-  
     return memeResultsDictsList
 
+atexit.register(flush_generation_logs)
+atexit.register(shutdown_render_pool)
+
 if __name__ == "__main__":
-    generate()
+    args = build_arg_parser().parse_args()
+    if args.logstats is not None:
+        print_log_stats(args.logstats or os.path.join(get_settings().get('Output_Folder', 'Outputs'), "log.jsonl"), args.logplatform)
+    else:
+        generate(args=args)
@@ -1,75 +1,349 @@
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory
-import os
-from AIMemeGenerator import generate
-
-app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'Outputs'
-
-@app.route('/static/<path:filename>')
-def serve_static(filename):
-    return send_from_directory('static', filename)
-
-@app.route('/', methods=['GET', 'POST'])
-def index():
-    if request.method == 'POST':
-        user_prompt = request.form['user_prompt']
-        meme_count = int(request.form['meme_count'])
-        
-        # Generate multiple memes
-        meme_results = generate(
-            user_entered_prompt=user_prompt,
-            meme_count=meme_count,
-            noUserInput=True,
-            noFileSave=False
-        )
-        
-        # Collect all generated filenames
-        meme_filenames = [meme['file_name'] for meme in meme_results]
-        
-        # Redirect to result page with all filenames
-        return redirect(url_for('result', 
-                              meme_filenames=','.join(meme_filenames),
-                              user_prompt=user_prompt,
-                              meme_count=meme_count,
-                              meme_index=0))  # Start with first meme
-    
-    # Get previous inputs for regeneration
-    prefill = {
-        'user_prompt': request.args.get('user_prompt', ''),
-        'meme_count': request.args.get('meme_count', '1')
-    }
-    return render_template('index.html', prefill=prefill)
-
-@app.route('/result')
-def result():
-    meme_filenames = request.args.get('meme_filenames', '').split(',')
-    meme_index = int(request.args.get('meme_index', 0))
-    user_prompt = request.args.get('user_prompt')
-    meme_count = int(request.args.get('meme_count', 1))
-    
-    # Handle index wrapping for continuous cycling
-    meme_index = meme_index % len(meme_filenames)
-    current_meme = meme_filenames[meme_index]
-    
-    return render_template('result.html',
-                         current_meme=current_meme,
-                         meme_filenames=meme_filenames,
-                         meme_index=meme_index,
-                         user_prompt=user_prompt,
-                         meme_count=meme_count)
-
-@app.route('/outputs/<filename>')
-def outputs(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
-
-@app.route('/download/<filename>')
-def download(filename):
-    return send_from_directory(
-        app.config['UPLOAD_FOLDER'],
-        filename,
-        as_attachment=True,
-        download_name=f"meme_{filename}"
-    )
-
-if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+from flask import Flask, render_template, request, redirect, url_for, send_from_directory, send_file, jsonify, abort, Response, stream_with_context
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+import time
+import uuid
+from werkzeug.utils import safe_join
+from AIMemeGenerator import generate, get_meme_store, get_derivative_path, is_meme_file_name, metrics, MemeGenerationError
+
+app = Flask(__name__)
+app.config['UPLOAD_FOLDER'] = 'Outputs'
+# Number of meme batches generated at the same time by this process. Further jobs wait in the executor's queue.
+app.config['JOB_WORKERS'] = int(os.environ.get('MEME_JOB_WORKERS', 4))
+# Finished jobs are forgotten after this many seconds
+app.config['JOB_TTL'] = int(os.environ.get('MEME_JOB_TTL', 3600))
+# How long browsers keep a meme image without asking again. A file name is never reused, so a meme's file never changes.
+app.config['MEME_MAX_AGE'] = int(os.environ.get('MEME_MAX_AGE', 365 * 24 * 3600))
+# The smaller WebP copies saved next to each meme (see Save_Web_Images in settings.ini), asked for with ?size=
+MEME_SIZES = ('web', 'thumb')
+
+# Jobs and their events only exist in the memory of the process that runs them, so every request about a job has to reach that process.
+# Run the web app as a single process and get concurrency from threads instead, for example:
+#     gunicorn --workers 1 --threads 8 app:app
+# With more than one worker, /result?job_id=, /jobs/<id>, its results and its events return 404 whenever they reach a different worker.
+job_executor = ThreadPoolExecutor(max_workers=app.config['JOB_WORKERS'])
+jobs = {}
+jobs_lock = threading.Lock()
+
+
+class MemeJob:
+    def __init__(self, user_prompt, meme_count):
+        self.id = uuid.uuid4().hex
+        self.user_prompt = user_prompt
+        self.meme_count = meme_count
+        self.status = 'queued'
+        self.error = None
+        self.finished_at = None
+        self.memes = {}
+        self.failures = {}
+        self.events = []
+        self.condition = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def ready_filenames(self):
+        with self.condition:
+            return [self.memes[i]['file_name'] for i in sorted(self.memes)]
+
+    def snapshot(self):
+        # The memes shown on a page, with the position of the first event that page hasn't seen yet, taken together so no event is missed or shown twice
+        with self.condition:
+            return sorted(self.memes), self.ready_filenames(), self.status, len(self.events)
+
+    def add_event(self, event, index, data):
+        with self.condition:
+            if event == 'render_done':
+                data = {
+                    'file_name': data['file_name'],
+                    'meme_text': data['meme_text'],
+                    'image_prompt': data['image_prompt'],
+                }
+                self.memes[index] = dict(data, index=index)
+            elif event == 'meme_failed':
+                self.failures[index] = data['error']
+            self.events.append({'event': event, 'index': index, 'data': data})
+            self.condition.notify_all()
+
+    def finished_before(self, cutoff):
+        with self.condition:
+            return self.finished and self.finished_at < cutoff
+
+    def set_status(self, status, error=None):
+        with self.condition:
+            # finished_at is set first, so a job that reads as finished always has one
+            if status in ('done', 'failed'):
+                self.finished_at = time.time()
+            self.status = status
+            self.error = error
+            self.events.append({'event': f'job_{status}', 'index': None, 'data': {'error': error}})
+            self.condition.notify_all()
+
+    def to_dict(self):
+        with self.condition:
+            return {
+                'job_id': self.id,
+                'status': self.status,
+                'error': self.error,
+                'user_prompt': self.user_prompt,
+                'meme_count': self.meme_count,
+                'completed': len(self.memes),
+                'memes': [self.memes[i] for i in sorted(self.memes)],
+                'failed': [{'index': i, 'error': self.failures[i]} for i in sorted(self.failures)],
+            }
+
+
+def run_job(job):
+    job.set_status('running')
+    metrics.inc('jobs_started_total')
+    try:
+        # Headless, so errors come back as exceptions instead of exiting the worker, and no shell is started to clear the screen
+        generate(
+            user_entered_prompt=job.user_prompt,
+            meme_count=job.meme_count,
+            noFileSave=False,
+            event_callback=job.add_event,
+            headless=True
+        )
+    except MemeGenerationError as ex:
+        metrics.inc('jobs_finished_total', status='failed')
+        job.set_status('failed', error=str(ex))
+    except Exception as ex:
+        app.logger.exception('Meme job %s failed', job.id)
+        metrics.inc('jobs_finished_total', status='failed')
+        job.set_status('failed', error=str(ex) or type(ex).__name__)
+    else:
+        metrics.inc('jobs_finished_total', status='done')
+        job.set_status('done')
+
+
+def prune_jobs():
+    cutoff = time.time() - app.config['JOB_TTL']
+    with jobs_lock:
+        for job_id in [job_id for job_id, job in jobs.items() if job.finished_before(cutoff)]:
+            del jobs[job_id]
+
+
+def submit_job(user_prompt, meme_count):
+    prune_jobs()
+    job = MemeJob(user_prompt, meme_count)
+    with jobs_lock:
+        jobs[job.id] = job
+    job_executor.submit(run_job, job)
+
+    return job
+
+
+def get_job(job_id):
+    with jobs_lock:
+        job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+
+    return job
+
+
+@app.route('/static/<path:filename>')
+def serve_static(filename):
+    return send_from_directory('static', filename)
+
+@app.route('/', methods=['GET', 'POST'])
+def index():
+    if request.method == 'POST':
+        user_prompt = request.form['user_prompt']
+        meme_count = int(request.form['meme_count'])
+
+        # Generate the memes in the background, the result page fills in as they finish
+        job = submit_job(user_prompt, meme_count)
+
+        return redirect(url_for('result',
+                              job_id=job.id,
+                              user_prompt=user_prompt,
+                              meme_count=meme_count,
+                              meme_index=0))  # Start with first meme
+
+    # Get previous inputs for regeneration
+    prefill = {
+        'user_prompt': request.args.get('user_prompt', ''),
+        'meme_count': request.args.get('meme_count', '1')
+    }
+    return render_template('index.html', prefill=prefill)
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    data = request.get_json(silent=True) or request.form
+    user_prompt = data.get('user_prompt', 'anything')
+    try:
+        meme_count = int(data.get('meme_count', 1))
+    except (TypeError, ValueError):
+        abort(400)
+    if meme_count < 1:
+        abort(400)
+
+    job = submit_job(user_prompt, meme_count)
+
+    response = jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': url_for('job_status', job_id=job.id),
+        'results_url': url_for('job_results', job_id=job.id),
+    })
+    response.status_code = 202
+    response.headers['Location'] = url_for('job_status', job_id=job.id)
+    return response
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    return jsonify(get_job(job_id).to_dict())
+
+@app.route('/jobs/<job_id>/results')
+def job_results(job_id):
+    job = get_job(job_id)
+
+    # Streams one JSON line per meme as soon as it is rendered, followed by a final line with the job status
+    def stream():
+        sent = set()
+        while True:
+            with job.condition:
+                pending = [job.memes[i] for i in sorted(job.memes) if i not in sent]
+                if not pending:
+                    if job.finished:
+                        break
+                    job.condition.wait(timeout=15)
+                    continue
+            for meme in pending:
+                sent.add(meme['index'])
+                yield json.dumps(dict(meme, **meme_urls(meme['file_name']))) + '\n'
+        yield json.dumps({'status': job.status, 'error': job.error}) + '\n'
+
+    return Response(stream_with_context(stream()), mimetype='application/x-ndjson')
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = get_job(job_id)
+    # The browser sends the last event id back when it reconnects, so no stage event is sent twice or lost.
+    # On the first connection, ?after= skips the events the page was already rendered with.
+    try:
+        next_event = int(request.headers.get('Last-Event-ID', -1)) + 1
+    except ValueError:
+        next_event = 0
+    if 'Last-Event-ID' not in request.headers:
+        next_event = max(next_event, request.args.get('after', 0, type=int))
+
+    def stream():
+        position = next_event
+        while True:
+            with job.condition:
+                pending = job.events[position:]
+                if not pending:
+                    if job.finished:
+                        break
+                    if not job.condition.wait(timeout=15):
+                        pending = None
+            if pending is None:
+                # Comment line that keeps proxies from closing an idle connection
+                yield ': keep-alive\n\n'
+                continue
+            for event in pending:
+                data = dict(event['data'], index=event['index'])
+                if event['event'] == 'render_done':
+                    data.update(meme_urls(data['file_name']))
+                    data['download_url'] = url_for('download', filename=data['file_name'])
+                yield f"id: {position}\nevent: {event['event']}\ndata: {json.dumps(data)}\n\n"
+                position += 1
+
+    response = Response(stream_with_context(stream()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Prometheus text format. Each gunicorn worker keeps its own counts, so scrape every worker or run a single one.
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/result')
+def result():
+    job_id = request.args.get('job_id')
+    job_status = None
+    next_event = 0
+    if job_id:
+        job = get_job(job_id)
+        meme_indices, meme_filenames, job_status, next_event = job.snapshot()
+    else:
+        meme_filenames = request.args.get('meme_filenames', '').split(',')
+        meme_indices = list(range(len(meme_filenames)))
+    meme_index = int(request.args.get('meme_index', 0))
+    # ?meme= picks a meme by its number in the job, which stays the same while memes finish out of order, unlike its place among the ready ones
+    meme = request.args.get('meme', type=int)
+    if meme in meme_indices:
+        meme_index = meme_indices.index(meme)
+    user_prompt = request.args.get('user_prompt')
+    meme_count = int(request.args.get('meme_count', 1))
+
+    # Handle index wrapping for continuous cycling
+    if meme_filenames:
+        meme_index = meme_index % len(meme_filenames)
+        current_meme = meme_filenames[meme_index]
+    else:
+        meme_index = 0
+        current_meme = None
+
+    return render_template('result.html',
+                         current_meme=current_meme,
+                         meme_filenames=meme_filenames,
+                         meme_indices=meme_indices,
+                         meme_index=meme_index,
+                         user_prompt=user_prompt,
+                         meme_count=meme_count,
+                         job_id=job_id,
+                         job_status=job_status,
+                         next_event=next_event)
+
+def meme_urls(filename):
+    return {
+        'url': url_for('outputs', filename=filename),
+        'web_url': url_for('outputs', filename=filename, size='web'),
+        'thumb_url': url_for('outputs', filename=filename, size='thumb'),
+    }
+
+def send_meme(filename, size=None, **kwargs):
+    # Memes live in shard folders, so the index says where each one is. Memes saved before the index existed are still in the top folder.
+    path = get_meme_store(app.config['UPLOAD_FOLDER']).lookup(filename)
+    # The output folder also holds the meme index and the generation log, which have every user's prompts in them, so only meme names are looked for there
+    if path is None and is_meme_file_name(filename):
+        path = safe_join(os.path.abspath(app.config['UPLOAD_FOLDER']), filename)
+    if path is None:
+        abort(404)
+    # Memes saved before the smaller copies existed are sent at full size
+    if size and os.path.isfile(get_derivative_path(path, size)):
+        path = get_derivative_path(path, size)
+    if not os.path.isfile(path):
+        abort(404)
+
+    # send_file() adds an ETag and Last-Modified, and answers a matching If-None-Match or If-Modified-Since with 304 Not Modified
+    response = send_file(path, conditional=True, etag=True, max_age=app.config['MEME_MAX_AGE'], **kwargs)
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/outputs/<filename>')
+def outputs(filename):
+    size = request.args.get('size')
+    if size is not None and size not in MEME_SIZES:
+        abort(400)
+
+    return send_meme(filename, size)
+
+@app.route('/download/<filename>')
+def download(filename):
+    return send_meme(
+        filename,
+        as_attachment=True,
+        download_name=f"meme_{filename}"
+    )
+
+if __name__ == '__main__':
+    app.run(debug=True)
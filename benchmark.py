@@ -0,0 +1,454 @@
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import AIMemeGenerator
+from AIMemeGenerator import metrics, percentile
+
+
+# Runs generate() and the Flask job routes against local fakes of the OpenAI, Stability and ClipDrop APIs,
+# so throughput can be measured (and compared against a saved baseline) without spending any API credits.
+# Also times a cold import of AIMemeGenerator against a budget, since every web worker pays it when it boots.
+#
+#   python benchmark.py --memecounts 1 4 16 --modes sequential concurrent:4 pipeline --save-baseline bench.json
+#   python benchmark.py --compare bench.json
+
+
+def make_image_payload(size):
+    from PIL import Image
+
+    # Random pixels barely compress, so the PNG comes out close to width * height * 3 bytes
+    side = max(16, int((size / 3) ** 0.5))
+    image = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    payload = io.BytesIO()
+    image.save(payload, format="PNG", compress_level=0)
+
+    return payload.getvalue()
+
+
+class FakeLatency:
+    def __init__(self, latency, jitter):
+        self.latency = latency
+        self.jitter = jitter
+
+    def seconds(self):
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def wait(self):
+        time.sleep(self.seconds())
+
+    async def async_wait(self):
+        await asyncio.sleep(self.seconds())
+
+
+class FakeChatCompletions:
+    def __init__(self, latency):
+        self.latency = latency
+        self.counter = 0
+        self.lock = threading.Lock()
+
+    def create(self, model, messages, temperature=1.0, n=1, **kwargs):
+        self.latency.wait()
+        return self.reply(messages, n)
+
+    def reply(self, messages, n):
+        with self.lock:
+            self.counter += 1
+            counter = self.counter
+
+        # Answers batched requests ("Create N different memes...") with N pairs, like the real model would
+        requested = 1
+        for word in messages[-1]["content"].split("(Create ", 1)[1:]:
+            requested = int(word.split(" ", 1)[0])
+        content = "\n\n".join(f'Meme Text: "Benchmark meme {counter}.{index}"\nImage Prompt: a photograph of benchmark {counter}.{index}' for index in range(requested))
+
+        message = types.SimpleNamespace(content=content, role="assistant")
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message) for _ in range(n)])
+
+
+class FakeImages:
+    def __init__(self, latency, payload):
+        self.latency = latency
+        self.b64_payload = base64.b64encode(payload).decode("ascii")
+
+    def generate(self, **kwargs):
+        self.latency.wait()
+        return types.SimpleNamespace(data=[types.SimpleNamespace(b64_json=self.b64_payload)])
+
+
+class FakeOpenAI:
+    def __init__(self, text_latency, image_latency, payload):
+        self.chat = types.SimpleNamespace(completions=FakeChatCompletions(text_latency))
+        self.images = FakeImages(image_latency, payload)
+
+    def with_options(self, **kwargs):
+        return self
+
+
+class FakeStability:
+    def __init__(self, latency, payload):
+        self.latency = latency
+        self.payload = payload
+
+    def generate(self, **kwargs):
+        from stability_sdk.interfaces.gooseai.generation import generation_pb2 as generation
+
+        self.latency.wait()
+        artifact = types.SimpleNamespace(type=generation.ARTIFACT_IMAGE, finish_reason=generation.NULL, binary=self.payload)
+        yield types.SimpleNamespace(artifacts=[artifact])
+
+
+class FakeClipDropResponse:
+    def __init__(self, payload):
+        self.payload = payload
+        self.ok = True
+        self.status_code = 200
+        self.headers = {"Content-Length": str(len(payload))}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def iter_content(self, chunk_size=65536):
+        for start in range(0, len(self.payload), chunk_size):
+            yield self.payload[start:start + chunk_size]
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeClipDropSession:
+    def __init__(self, latency, payload):
+        self.latency = latency
+        self.payload = payload
+
+    def post(self, url, **kwargs):
+        self.latency.wait()
+        return FakeClipDropResponse(self.payload)
+
+
+class FakeAsyncOpenAI:
+    # Same answers as FakeOpenAI, but awaited like openai.AsyncOpenAI
+    def __init__(self, fake_openai):
+        self.fake_openai = fake_openai
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create_chat))
+        self.images = types.SimpleNamespace(generate=self.generate_image)
+
+    def with_options(self, **kwargs):
+        return self
+
+    async def create_chat(self, messages, n=1, **kwargs):
+        completions = self.fake_openai.chat.completions
+        await completions.latency.async_wait()
+        return completions.reply(messages, n)
+
+    async def generate_image(self, **kwargs):
+        await self.fake_openai.images.latency.async_wait()
+        return types.SimpleNamespace(data=[types.SimpleNamespace(b64_json=self.fake_openai.images.b64_payload)])
+
+
+class FakeAsyncClipDropResponse(FakeClipDropResponse):
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def aiter_bytes(self):
+        for chunk in self.iter_content():
+            yield chunk
+
+
+class FakeAsyncClipDropClient:
+    def __init__(self, latency, payload):
+        self.latency = latency
+        self.payload = payload
+
+    def stream(self, method, url, **kwargs):
+        client = self
+
+        class Request:
+            async def __aenter__(self):
+                await client.latency.async_wait()
+                return FakeAsyncClipDropResponse(client.payload)
+
+            async def __aexit__(self, *exc):
+                return False
+
+        return Request()
+
+
+def install_fakes(options):
+    payload = make_image_payload(options.payload_bytes)
+    text_latency = FakeLatency(options.text_latency, options.jitter)
+    image_latency = FakeLatency(options.image_latency, options.jitter)
+    fakes = (FakeStability(image_latency, payload), FakeOpenAI(text_latency, image_latency, payload), FakeClipDropSession(image_latency, payload))
+
+    AIMemeGenerator.get_api_clients = lambda *args, **kwargs: fakes
+    asyncFakes = (FakeAsyncOpenAI(fakes[1]), FakeAsyncClipDropClient(image_latency, payload))
+    AIMemeGenerator.get_async_api_clients = lambda *args, **kwargs: asyncFakes
+    # The web app leaves the keys to api_keys.ini
+    AIMemeGenerator.get_api_keys = lambda *args, **kwargs: AIMemeGenerator.ApiKeysTupleClass("benchmark", "benchmark", "benchmark")
+
+
+def make_settings(options, mode):
+    # Starts from settings.ini so the benchmark measures the configured layout, output format and so on
+    settings = dict(options.base_settings)
+    settings.update({
+        "Use_This_Config": True,
+        "Image_Platform": options.platform,
+        "Font_File": options.font,
+        "Output_Folder": "Outputs",
+        "Max_Concurrent_Memes": 1,
+        "Use_Pipeline": False,
+        "Use_Image_Cache": False,
+        "Use_Caption_Cache": False,
+    })
+    if mode.startswith(("concurrent", "async")):
+        settings["Max_Concurrent_Memes"] = int(mode.partition(":")[2] or (1000 if mode.startswith("async") else 4))
+    elif mode.startswith("pipeline"):
+        settings["Use_Pipeline"] = True
+        settings["Pipeline_Render_Workers"] = int(mode.partition(":")[2] or 2)
+
+    return settings
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    return round(max(own, children) / scale, 1)
+
+
+def render_cpu_seconds():
+    # Measured by render_meme_file() in the thread or pool process that renders, so it is CPU time rather than wall time
+    with metrics.lock:
+        return sum(histogram["sum"] for (name, labels), histogram in metrics.histograms.items() if name == "render_cpu_seconds")
+
+
+def run_generate(options, meme_count, mode):
+    started = {}
+    latencies = []
+    lock = threading.Lock()
+
+    def on_event(event, index, data):
+        with lock:
+            if event == "meme_started":
+                started[index] = time.perf_counter()
+            elif event == "render_done":
+                latencies.append(time.perf_counter() - started[index])
+
+    AIMemeGenerator.get_settings = lambda *args, **kwargs: make_settings(options, mode)
+    renderBefore = render_cpu_seconds()
+
+    runOptions = {
+        "user_entered_prompt": "benchmark",
+        "meme_count": meme_count,
+        "openai_key": "benchmark",
+        "stability_key": "benchmark",
+        "clipdrop_key": "benchmark",
+        "headless": True,
+        "event_callback": on_event,
+    }
+    runStart = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if mode.startswith("async"):
+            asyncio.run(AIMemeGenerator.agenerate(**runOptions))
+        else:
+            AIMemeGenerator.generate(**runOptions)
+    elapsed = time.perf_counter() - runStart
+
+    return summarize(f"{'agenerate' if mode.startswith('async') else 'generate'} {mode}", meme_count, elapsed, latencies, render_cpu_seconds() - renderBefore)
+
+
+def run_flask(options, meme_count, users):
+    import app as web
+
+    AIMemeGenerator.get_settings = lambda *args, **kwargs: make_settings(options, "sequential")
+    client = web.app.test_client()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def user():
+        submitted = time.perf_counter()
+        job = client.post("/jobs", json={"user_prompt": "benchmark", "meme_count": meme_count}).get_json()
+        # Reading the streamed results waits until the last meme of the job is done
+        lines = client.get(job["results_url"]).get_data(as_text=True).splitlines()
+        with lock:
+            latencies.append(time.perf_counter() - submitted)
+            if json.loads(lines[-1])["status"] != "done":
+                errors.append(json.loads(lines[-1])["error"])
+
+    renderBefore = render_cpu_seconds()
+    runStart = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        threads = [threading.Thread(target=user) for _ in range(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - runStart
+    if errors:
+        raise RuntimeError(f"{len(errors)} of {users} benchmark jobs failed: {errors[0]}")
+
+    return summarize(f"flask {users} users", meme_count * users, elapsed, latencies, render_cpu_seconds() - renderBefore)
+
+
+# Modules that must only be loaded once a platform actually needs them
+heavy_modules = ("openai", "httpx", "requests", "stability_sdk", "grpc", "google.protobuf", "PIL")
+
+import_probe = """
+import sys, time
+start = time.perf_counter()
+import AIMemeGenerator
+print(time.perf_counter() - start)
+print(",".join(module for module in sys.argv[1:] if module in sys.modules))
+"""
+
+
+def measure_import(runs=5):
+    # Each run is a fresh interpreter, so nothing is already cached in sys.modules
+    seconds = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, "-c", import_probe, *heavy_modules], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.splitlines()
+        seconds.append(float(output[0]))
+        loaded = [module for module in output[1].split(",") if module] if len(output) > 1 else []
+
+    return {"import_ms": round(statistics.median(seconds) * 1000, 1), "heavy_modules_loaded": loaded}
+
+
+def summarize(scenario, meme_count, elapsed, latencies, render_seconds):
+    latencies = sorted(latencies)
+
+    return {
+        "scenario": scenario,
+        "meme_count": meme_count,
+        "seconds": round(elapsed, 3),
+        "memes_per_second": round(meme_count / elapsed, 3) if elapsed else None,
+        "p50": round(percentile(latencies, 50), 3) if latencies else None,
+        "p99": round(percentile(latencies, 99), 3) if latencies else None,
+        "render_cpu_seconds": round(render_seconds, 3),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def print_results(results):
+    print(f"\n  {'Scenario':<24}{'Memes':>7}{'Seconds':>10}{'Memes/s':>10}{'p50':>9}{'p99':>9}{'Render CPU':>12}{'Peak RSS':>11}")
+    for result in results:
+        print(f"  {result['scenario']:<24}{result['meme_count']:>7}{result['seconds']:>10.3f}{result['memes_per_second']:>10.2f}"
+              f"{result['p50']:>8.3f}s{result['p99']:>8.3f}s{result['render_cpu_seconds']:>11.3f}s{result['peak_rss_mb']:>8.1f} MB")
+
+
+def check_import(importResult, budget_ms):
+    print(f"\n  Cold import of AIMemeGenerator: {importResult['import_ms']:.1f} ms (budget {budget_ms:.0f} ms)")
+    problems = []
+    if importResult["import_ms"] > budget_ms:
+        problems.append(f"import took {importResult['import_ms']:.1f} ms, over the {budget_ms:.0f} ms budget")
+    if importResult["heavy_modules_loaded"]:
+        problems.append("importing loaded " + ", ".join(importResult["heavy_modules_loaded"]))
+    for problem in problems:
+        print("   " + problem)
+
+    return not problems
+
+
+def compare_results(results, baseline_path, tolerance, importResult=None):
+    with open(baseline_path, encoding="utf-8") as baseline_file:
+        saved = json.load(baseline_file)
+    baseline = {(result["scenario"], result["meme_count"]): result for result in saved["results"]}
+
+    regressions = []
+    if importResult and saved.get("import") and importResult["import_ms"] > saved["import"]["import_ms"] * (1 + tolerance):
+        regressions.append(f"import: {importResult['import_ms']:.1f} ms, baseline {saved['import']['import_ms']:.1f} ms")
+    for result in results:
+        previous = baseline.get((result["scenario"], result["meme_count"]))
+        if not previous:
+            continue
+        if result["memes_per_second"] < previous["memes_per_second"] * (1 - tolerance):
+            regressions.append(f"{result['scenario']} x{result['meme_count']}: {result['memes_per_second']:.2f} memes/s, baseline {previous['memes_per_second']:.2f}")
+        if previous["p99"] and result["p99"] > previous["p99"] * (1 + tolerance):
+            regressions.append(f"{result['scenario']} x{result['meme_count']}: p99 {result['p99']:.3f}s, baseline {previous['p99']:.3f}s")
+
+    if regressions:
+        print(f"\nRegressions against {baseline_path} (tolerance {tolerance:.0%}):")
+        for regression in regressions:
+            print("   " + regression)
+    else:
+        print(f"\nNo regressions against {baseline_path} (tolerance {tolerance:.0%}).")
+
+    return not regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark meme generation against fake API providers.")
+    parser.add_argument("--memecounts", type=int, nargs="+", default=[1, 4, 16], help="Batch sizes to run.")
+    parser.add_argument("--modes", nargs="+", default=["sequential", "concurrent:4", "pipeline"], help="Execution modes: sequential, concurrent[:N] and pipeline[:render workers] run generate(), async[:N] runs agenerate().")
+    parser.add_argument("--flaskusers", type=int, nargs="*", default=[4], help="Numbers of simultaneous web users submitting jobs. Pass no values to skip the Flask runs.")
+    parser.add_argument("--platform", default="openai", choices=["openai", "stability", "clipdrop", "auto"])
+    parser.add_argument("--settings", default="settings.ini", help="Settings file the benchmark runs start from. API keys and caches are always overridden.")
+    parser.add_argument("--font", help="Font file to render with. Defaults to the one in the settings file.")
+    parser.add_argument("--text-latency", type=float, default=0.8, help="Seconds per fake chat completion.")
+    parser.add_argument("--image-latency", type=float, default=2.0, help="Seconds per fake image request.")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Random +/- seconds added to each fake request.")
+    parser.add_argument("--payload-bytes", type=int, default=1024 * 1024, help="Approximate size of the fake images.")
+    parser.add_argument("--import-budget-ms", type=float, default=150, help="Maximum time for a cold import of AIMemeGenerator. Exceeding it makes the benchmark exit with status 1.")
+    parser.add_argument("--save-baseline", metavar="PATH", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", metavar="PATH", help="Compare the results against a saved baseline and exit with status 1 on regressions.")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed slowdown against the baseline, as a fraction.")
+    options = parser.parse_args()
+
+    options.base_settings = AIMemeGenerator.get_config(options.settings) if os.path.isfile(options.settings) else {}
+    options.font = os.path.abspath(AIMemeGenerator.check_font(options.font or options.base_settings.get("Font_File", "arial.ttf")))
+    install_fakes(options)
+
+    workDir = tempfile.mkdtemp(prefix="meme-benchmark-")
+    startDir = os.getcwd()
+    os.chdir(workDir)
+    try:
+        results = []
+        for meme_count in options.memecounts:
+            for mode in options.modes:
+                results.append(run_generate(options, meme_count, mode))
+        for users in options.flaskusers:
+            results.append(run_flask(options, max(options.memecounts), users))
+    finally:
+        os.chdir(startDir)
+        AIMemeGenerator.flush_generation_logs()
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    print_results(results)
+    importResult = measure_import()
+    passed = check_import(importResult, options.import_budget_ms)
+
+    if options.save_baseline:
+        with open(options.save_baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump({"options": {key: value for key, value in vars(options).items() if key not in ("save_baseline", "compare", "base_settings")}, "import": importResult, "results": results}, baseline_file, indent=2)
+        print(f"\nBaseline saved to {options.save_baseline}")
+
+    if options.compare:
+        passed = compare_results(results, options.compare, options.tolerance, importResult) and passed
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import glob
+import os
+import time
+import types
+
+import pytest
+
+import AIMemeGenerator
+
+
+def find_test_font():
+    # Any TrueType font will do, the tests compare layouts made with the same font
+    fontFile = os.environ.get("MEME_TEST_FONT")
+    if fontFile and os.path.isfile(fontFile):
+        return fontFile
+    for directory in AIMemeGenerator.font_directories:
+        fontFiles = sorted(glob.glob(os.path.join(os.path.expanduser(directory), "**", "*.ttf"), recursive=True))
+        if fontFiles:
+            return fontFiles[0]
+    return None
+
+
+@pytest.fixture(scope="session")
+def font_file():
+    fontFile = find_test_font()
+    if fontFile is None:
+        pytest.skip("No TrueType font found, set MEME_TEST_FONT to one")
+    return fontFile
+
+
+@pytest.fixture
+def fake_apis(monkeypatch, tmp_path, font_file):
+    # generate() against the benchmark's fake API providers, writing into a temporary folder.
+    # Tests can change .settings, or swap .openai, .stability and .clipdrop for fakes that fail.
+    pytest.importorskip("PIL")
+    import benchmark
+    
+    options = types.SimpleNamespace(payload_bytes=4096, text_latency=0, image_latency=0, jitter=0, platform="openai", font=font_file,
+        base_settings=AIMemeGenerator.get_config(os.path.join(os.path.dirname(os.path.dirname(__file__)), "settings.ini")))
+    latency = benchmark.FakeLatency(0, 0)
+    payload = benchmark.make_image_payload(options.payload_bytes)
+    fakes = types.SimpleNamespace(settings=benchmark.make_settings(options, "sequential"), payload=payload)
+    fakes.openai = benchmark.FakeOpenAI(latency, latency, payload)
+    fakes.stability = benchmark.FakeStability(latency, payload)
+    fakes.clipdrop = benchmark.FakeClipDropSession(latency, payload)
+    
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(AIMemeGenerator, "get_settings", lambda *args, **kwargs: dict(fakes.settings))
+    monkeypatch.setattr(AIMemeGenerator, "get_api_keys", lambda *args, **kwargs: AIMemeGenerator.ApiKeysTupleClass("test", "test", "test"))
+    monkeypatch.setattr(AIMemeGenerator, "get_api_clients", lambda *args, **kwargs: (fakes.stability, fakes.openai, fakes.clipdrop))
+    yield fakes
+    AIMemeGenerator.flush_generation_logs()
+
+
+def run_generate(**kwargs):
+    return AIMemeGenerator.generate(user_entered_prompt="test", openai_key="test", stability_key="test", clipdrop_key="test", headless=True, **kwargs)
+
+
+@pytest.fixture
+def client(fake_apis):
+    pytest.importorskip("flask")
+    import app as web
+    
+    yield web.app.test_client()
+    with web.jobs_lock:
+        web.jobs.clear()
+
+
+def wait_for_job(client, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        status = client.get(f"/jobs/{job_id}").get_json()
+        if status["status"] in ("done", "failed"):
+            return status
+        time.sleep(0.05)
+    raise AssertionError(f"Job {job_id} did not finish")
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+flask = pytest.importorskip("flask")
+
+from tests.conftest import wait_for_job
+
+
+def read_events(response):
+    events = []
+    for block in response.get_data(as_text=True).strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+        events.append((int(fields["id"]), fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def finished_job(client, meme_count=2):
+    job_id = client.post("/jobs", json={"meme_count": meme_count}).get_json()["job_id"]
+    wait_for_job(client, job_id)
+    return job_id
+
+
+def test_events_cover_every_stage_in_order(client):
+    job_id = finished_job(client)
+    
+    response = client.get(f"/jobs/{job_id}/events")
+    events = read_events(response)
+    
+    assert response.mimetype == "text/event-stream"
+    assert [eventId for eventId, event, data in events] == list(range(len(events)))
+    assert events[0][1] == "job_running" and events[-1][1] == "job_done"
+    rendered = [data for eventId, event, data in events if event == "render_done"]
+    assert sorted(data["index"] for data in rendered) == [0, 1]
+    assert all(data["url"].startswith("/outputs/") and data["download_url"].startswith("/download/") for data in rendered)
+
+
+def test_reconnecting_resumes_after_the_last_event(client):
+    job_id = finished_job(client)
+    events = read_events(client.get(f"/jobs/{job_id}/events"))
+    
+    resumed = read_events(client.get(f"/jobs/{job_id}/events", headers={"Last-Event-ID": "2"}))
+    
+    assert resumed == events[3:]
+
+
+def test_first_connection_skips_events_the_page_was_rendered_with(client):
+    job_id = finished_job(client)
+    events = read_events(client.get(f"/jobs/{job_id}/events"))
+    
+    assert read_events(client.get(f"/jobs/{job_id}/events?after=4")) == events[4:]
+    # The browser's Last-Event-ID wins over the page's position once it has one
+    assert read_events(client.get(f"/jobs/{job_id}/events?after=4", headers={"Last-Event-ID": "0"})) == events[1:]
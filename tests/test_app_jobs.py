@@ -0,0 +1,50 @@
+import json
+
+import pytest
+
+flask = pytest.importorskip("flask")
+
+import app as web
+from tests.conftest import wait_for_job
+
+
+def test_job_runs_in_the_background(client):
+    response = client.post("/jobs", json={"user_prompt": "cats", "meme_count": 2})
+    
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+    assert response.headers["Location"].endswith(f"/jobs/{job_id}")
+    status = wait_for_job(client, job_id)
+    assert status["status"] == "done"
+    assert [meme["index"] for meme in status["memes"]] == [0, 1]
+
+
+def test_results_stream_one_line_per_meme(client):
+    job_id = client.post("/jobs", json={"meme_count": 2}).get_json()["job_id"]
+    
+    lines = [json.loads(line) for line in client.get(f"/jobs/{job_id}/results").get_data(as_text=True).splitlines()]
+    
+    assert sorted(line["index"] for line in lines[:-1]) == [0, 1]
+    assert all(line["url"].startswith("/outputs/") for line in lines[:-1])
+    assert lines[-1] == {"status": "done", "error": None}
+
+
+def test_bad_meme_count_is_rejected(client):
+    assert client.post("/jobs", json={"meme_count": 0}).status_code == 400
+    assert client.post("/jobs", json={"meme_count": "many"}).status_code == 400
+    assert client.get("/jobs/unknown").status_code == 404
+
+
+def test_finished_jobs_are_pruned(client):
+    expired = web.MemeJob("old", 1)
+    expired.set_status("done")
+    expired.finished_at -= web.app.config["JOB_TTL"] + 1
+    recent = web.MemeJob("recent", 1)
+    recent.set_status("failed", error="error")
+    running = web.MemeJob("running", 1)
+    with web.jobs_lock:
+        web.jobs.update({job.id: job for job in (expired, recent, running)})
+    
+    web.prune_jobs()
+    
+    assert set(web.jobs) == {recent.id, running.id}
@@ -0,0 +1,47 @@
+import io
+
+import pytest
+
+flask = pytest.importorskip("flask")
+Image = pytest.importorskip("PIL.Image")
+
+from tests.conftest import wait_for_job
+
+
+@pytest.fixture
+def memes(client, fake_apis):
+    # The fake images are 36 pixels wide, and the copies are never made larger than the meme
+    fake_apis.settings.update({"Save_Web_Images": True, "Thumbnail_Width": 16, "Web_Image_Width": 24})
+    job_id = client.post("/jobs", json={"meme_count": 2}).get_json()["job_id"]
+    return job_id, wait_for_job(client, job_id)["memes"]
+
+
+def test_unchanged_meme_is_not_sent_again(client, memes):
+    job_id, jobMemes = memes
+    url = f"/outputs/{jobMemes[0]['file_name']}"
+    
+    response = client.get(url)
+    
+    assert response.status_code == 200
+    assert response.cache_control.immutable and response.cache_control.max_age > 0
+    assert client.get(url, headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+
+def test_smaller_copies_are_served(client, memes):
+    job_id, jobMemes = memes
+    fileName = jobMemes[0]["file_name"]
+    
+    for size, width in (("web", 24), ("thumb", 16)):
+        response = client.get(f"/outputs/{fileName}?size={size}")
+        assert response.mimetype == "image/webp"
+        assert Image.open(io.BytesIO(response.get_data())).width == width
+    assert client.get(f"/outputs/{fileName}?size=huge").status_code == 400
+
+
+def test_result_page_picks_a_meme_by_its_number(client, memes):
+    job_id, jobMemes = memes
+    
+    page = client.get(f"/result?job_id={job_id}&meme=1").get_data(as_text=True)
+    
+    assert f'/outputs/{jobMemes[1]["file_name"]}?size=web' in page
+    assert f'/download/{jobMemes[1]["file_name"]}' in page
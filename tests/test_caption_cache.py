@@ -0,0 +1,33 @@
+from AIMemeGenerator import CaptionCache
+
+
+def test_caption_cache_keeps_newest_captions_per_prompt():
+    captionCache = CaptionCache(pool_size=2, max_prompts=10, reuse_ratio=1)
+    for number in range(3):
+        captionCache.add("prompt", {"meme_text": f"caption {number}"})
+    
+    samples = {captionCache.sample("prompt")["meme_text"] for _ in range(50)}
+    
+    assert samples == {"caption 1", "caption 2"}
+
+
+def test_caption_cache_evicts_least_recently_used_prompt():
+    captionCache = CaptionCache(pool_size=2, max_prompts=2, reuse_ratio=1)
+    captionCache.add("first", {"meme_text": "one"})
+    captionCache.add("second", {"meme_text": "two"})
+    # Using the first prompt again makes the second one the oldest
+    captionCache.sample("first")
+    captionCache.add("third", {"meme_text": "three"})
+    
+    assert captionCache.sample("second") is None
+    assert captionCache.sample("first") == {"meme_text": "one"}
+    assert captionCache.stats() == {"hits": 2, "misses": 1, "prompts": 2}
+
+
+def test_caption_cache_returns_copies():
+    captionCache = CaptionCache(pool_size=2, max_prompts=2, reuse_ratio=1)
+    captionCache.add("prompt", {"meme_text": "one"})
+    
+    captionCache.sample("prompt")["meme_text"] = "changed"
+    
+    assert captionCache.sample("prompt") == {"meme_text": "one"}
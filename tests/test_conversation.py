@@ -0,0 +1,58 @@
+import AIMemeGenerator
+from AIMemeGenerator import ConversationPolicyTupleClass, trim_conversation
+
+
+def make_conversation(turns):
+    conversation = [{"role": "system", "content": "You are a meme generator."}]
+    for turn in range(turns):
+        conversation.append({"role": "user", "content": f"prompt {turn}"})
+        conversation.append({"role": "assistant", "content": f"reply {turn}"})
+    conversation.append({"role": "user", "content": "latest prompt"})
+    return conversation
+
+
+def test_full_keeps_everything():
+    conversation = make_conversation(3)
+    
+    assert trim_conversation(conversation, ConversationPolicyTupleClass("full", 0, 0)) == conversation
+    assert trim_conversation(conversation) == conversation
+
+
+def test_stateless_keeps_system_and_latest_message():
+    conversation = make_conversation(3)
+    
+    assert trim_conversation(conversation, ConversationPolicyTupleClass("stateless", 0, 0)) == [conversation[0], conversation[-1]]
+
+
+def test_sliding_window_never_starts_with_a_reply():
+    conversation = make_conversation(3)
+    
+    # The last two messages are a reply and the latest prompt, and the reply has lost the prompt it answered
+    assert trim_conversation(conversation, ConversationPolicyTupleClass("sliding_window", 2, 0)) == [conversation[0], conversation[-1]]
+    assert trim_conversation(conversation, ConversationPolicyTupleClass("sliding_window", 3, 0)) == [conversation[0]] + conversation[-3:]
+
+
+def test_token_budget_keeps_newest_messages_that_fit():
+    conversation = make_conversation(3)
+    tokens = [AIMemeGenerator.estimate_message_tokens(message) for message in conversation]
+    # Room for the system prompt and the last three messages, but not a fourth
+    budget = tokens[0] + sum(tokens[-3:])
+    
+    trimmed = trim_conversation(conversation, ConversationPolicyTupleClass("token_budget", 0, budget))
+    
+    assert trimmed == [conversation[0]] + conversation[-3:]
+
+
+def test_token_budget_always_keeps_latest_message():
+    conversation = make_conversation(3)
+    
+    assert trim_conversation(conversation, ConversationPolicyTupleClass("token_budget", 0, 1)) == [conversation[0], conversation[-1]]
+
+
+def test_trimming_does_not_change_the_history():
+    conversation = make_conversation(3)
+    original = list(conversation)
+    
+    trim_conversation(conversation, ConversationPolicyTupleClass("stateless", 0, 0))
+    
+    assert conversation == original
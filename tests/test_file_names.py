@@ -0,0 +1,51 @@
+import itertools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import AIMemeGenerator
+from AIMemeGenerator import reserve_file_path, is_meme_file_name
+
+
+def test_names_are_unique_across_threads(tmp_path):
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        reserved = list(executor.map(lambda _: reserve_file_path("meme", str(tmp_path)), range(200)))
+    
+    assert len({fileName for filePath, fileName in reserved}) == 200
+    assert all(os.path.isfile(filePath) and is_meme_file_name(fileName) for filePath, fileName in reserved)
+
+
+def test_name_already_taken_is_skipped(tmp_path, monkeypatch):
+    monkeypatch.setattr(AIMemeGenerator, "file_name_counter", itertools.count(1))
+    firstPath, firstName = reserve_file_path("meme", str(tmp_path))
+    # Another process that started its counter at the same number already has this name
+    monkeypatch.setattr(AIMemeGenerator, "file_name_counter", itertools.count(1))
+    
+    secondPath, secondName = reserve_file_path("meme", str(tmp_path))
+    
+    assert secondName != firstName
+    assert os.path.isfile(firstPath) and os.path.isfile(secondPath)
+
+
+@pytest.mark.parametrize("sharding, depth", [("none", 0), ("date", 3), ("hash", 2)])
+def test_sharded_names_go_into_subfolders(tmp_path, sharding, depth):
+    filePath, fileName = reserve_file_path("meme", str(tmp_path), extension="webp", sharding=sharding)
+    
+    assert os.path.basename(filePath) == fileName and fileName.endswith(".webp")
+    assert len(os.path.relpath(os.path.dirname(filePath), tmp_path).split(os.sep)) == max(depth, 1)
+    assert os.path.isfile(filePath)
+
+
+def test_folders_are_made_again_in_a_new_working_folder(tmp_path, monkeypatch):
+    for folder in ("first", "second"):
+        os.makedirs(tmp_path / folder)
+        monkeypatch.chdir(tmp_path / folder)
+        filePath, fileName = reserve_file_path("meme", "Outputs", sharding="date")
+        assert os.path.isfile(filePath)
+
+
+def test_no_file_save_creates_no_file(tmp_path):
+    filePath, fileName = reserve_file_path("meme", str(tmp_path), noFileSave=True)
+    
+    assert not os.path.exists(filePath)
@@ -0,0 +1,104 @@
+import types
+
+import pytest
+
+import AIMemeGenerator
+from tests.conftest import run_generate
+
+
+class RejectingClipDropResponse:
+    def __init__(self, status_code):
+        self.ok = False
+        self.status_code = status_code
+        self.headers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        import requests
+        raise requests.HTTPError(f"{self.status_code} Client Error", response=self)
+
+
+class RejectingClipDropSession:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.calls = 0
+
+    def post(self, url, **kwargs):
+        self.calls += 1
+        return RejectingClipDropResponse(self.status_code)
+
+
+class FakeRpcError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+    def code(self):
+        return types.SimpleNamespace(name=self.status)
+
+
+class RejectingStability:
+    def __init__(self, status):
+        self.status = status
+
+    def generate(self, **kwargs):
+        raise FakeRpcError(self.status)
+
+
+def test_clipdrop_auth_error_stops_the_batch(fake_apis):
+    fake_apis.settings["Image_Platform"] = "clipdrop"
+    fake_apis.clipdrop = RejectingClipDropSession(401)
+    
+    with pytest.raises(AIMemeGenerator.APIAuthenticationError):
+        run_generate(meme_count=3)
+    # The first rejected key ends the batch, rather than every meme trying it in turn
+    assert fake_apis.clipdrop.calls == 1
+
+
+@pytest.mark.parametrize("status", ["UNAUTHENTICATED", "PERMISSION_DENIED"])
+def test_stability_auth_error_stops_the_batch(fake_apis, status):
+    fake_apis.settings["Image_Platform"] = "stability"
+    fake_apis.stability = RejectingStability(status)
+    
+    with pytest.raises(AIMemeGenerator.APIAuthenticationError):
+        run_generate(meme_count=2)
+
+
+def test_failed_memes_carry_typed_errors(fake_apis):
+    fake_apis.settings["Image_Platform"] = "clipdrop"
+    images = fake_apis.clipdrop
+    failing = RejectingClipDropSession(429)
+    
+    class FirstFails:
+        calls = 0
+        
+        def post(self, url, **kwargs):
+            self.calls += 1
+            return (failing if self.calls == 1 else images).post(url, **kwargs)
+    
+    fake_apis.clipdrop = FirstFails()
+    
+    fake_apis.settings["Image_Max_Retries"] = 0
+    
+    memeResults = run_generate(meme_count=2)
+    
+    assert len(memeResults) == 1
+    assert list(memeResults.errors) == [0]
+    assert isinstance(memeResults.errors[0], AIMemeGenerator.APIRateLimitError)
+
+
+def test_every_meme_failing_raises_batch_error(fake_apis):
+    fake_apis.settings["Image_Platform"] = "clipdrop"
+    fake_apis.settings["Image_Max_Retries"] = 0
+    fake_apis.clipdrop = RejectingClipDropSession(500)
+    
+    with pytest.raises(AIMemeGenerator.MemeBatchError) as raised:
+        run_generate(meme_count=2)
+    
+    assert sorted(raised.value.errors) == [0, 1]
+    assert all(isinstance(error, AIMemeGenerator.MemeGenerationError) for error in raised.value.errors.values())
@@ -0,0 +1,47 @@
+import os
+import time
+
+from AIMemeGenerator import ImageCache
+from tests.conftest import run_generate
+
+
+def test_image_cache_counts_one_miss_per_lookup(tmp_path):
+    imageCache = ImageCache(str(tmp_path), max_bytes=0, ttl_seconds=0)
+    keys = [ImageCache.make_key(platform, "a cat") for platform in ("openai", "stability", "clipdrop")]
+    
+    assert imageCache.get_first(keys) == (None, None)
+    imageCache.put(keys[1], b"image")
+    key, virtual_image_file = imageCache.get_first(keys)
+    
+    assert key == keys[1]
+    assert virtual_image_file.read() == b"image"
+    assert (imageCache.hits, imageCache.misses) == (1, 1)
+
+
+def test_image_cache_replacing_an_entry_keeps_total_size(tmp_path):
+    imageCache = ImageCache(str(tmp_path), max_bytes=0, ttl_seconds=0)
+    key = ImageCache.make_key("openai", "a cat")
+    
+    imageCache.put(key, b"image")
+    imageCache.put(key, b"image")
+    
+    assert imageCache.total_bytes == len(b"image")
+
+
+def test_expired_entries_are_missed(tmp_path):
+    imageCache = ImageCache(str(tmp_path), max_bytes=0, ttl_seconds=60)
+    key = ImageCache.make_key("openai", "a cat")
+    imageCache.put(key, b"image")
+    old = time.time() - 120
+    os.utime(imageCache.get_path(key), (old, old))
+    
+    assert imageCache.get(key) is None
+    assert imageCache.total_bytes == 0
+
+
+def test_generate_leaves_the_cache_off_by_default(fake_apis, font_file):
+    fake_apis.settings["Use_This_Config"] = False
+    
+    run_generate(meme_count=1, font_file=font_file, image_cache_folder="Image_Cache")
+    
+    assert not os.path.exists("Image_Cache")
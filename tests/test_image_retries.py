@@ -0,0 +1,112 @@
+import io
+import threading
+import time
+import types
+
+import pytest
+
+import AIMemeGenerator
+from AIMemeGenerator import ImageRetryPolicyTupleClass, retrying_image_generation_request, hedged_image_generation_request
+
+requests = pytest.importorskip("requests")
+
+apiKeys = AIMemeGenerator.ApiKeysTupleClass("k", "c", "s")
+retryPolicy = ImageRetryPolicyTupleClass(timeouts={"clipdrop": 7}, max_retries=2, backoff_base=0.001, backoff_max=0.01, hedge=False, hedge_percentile=95)
+
+
+def http_error(status_code, headers=None):
+    return requests.HTTPError(f"{status_code} Error", response=types.SimpleNamespace(status_code=status_code, headers=headers or {}))
+
+
+class FakeRequests:
+    # Stands in for image_generation_request(): raises the given errors in turn, then returns an image
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.timeouts = []
+
+    def __call__(self, apiKeys, image_prompt, platform, openai_api, stability_api=None, clipdrop_session=None, timeout=None):
+        self.timeouts.append(timeout)
+        if self.errors:
+            raise self.errors.pop(0)
+        return io.BytesIO(b"image")
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(AIMemeGenerator.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_retryable_errors_are_retried(monkeypatch, sleeps):
+    fake = FakeRequests(http_error(503), http_error(429))
+    monkeypatch.setattr(AIMemeGenerator, "image_generation_request", fake)
+    
+    assert retrying_image_generation_request(apiKeys, "a cat", "clipdrop", None, retryPolicy=retryPolicy).read() == b"image"
+    assert fake.timeouts == [7, 7, 7]
+    assert len(sleeps) == 2 and all(0 <= delay <= retryPolicy.backoff_max for delay in sleeps)
+
+
+def test_other_errors_are_not_retried(monkeypatch, sleeps):
+    fake = FakeRequests(http_error(400))
+    monkeypatch.setattr(AIMemeGenerator, "image_generation_request", fake)
+    
+    with pytest.raises(requests.HTTPError):
+        retrying_image_generation_request(apiKeys, "a cat", "clipdrop", None, retryPolicy=retryPolicy)
+    assert len(fake.timeouts) == 1 and sleeps == []
+
+
+def test_retries_give_up_after_max_retries(monkeypatch, sleeps):
+    fake = FakeRequests(*[http_error(500)] * 5)
+    monkeypatch.setattr(AIMemeGenerator, "image_generation_request", fake)
+    
+    with pytest.raises(requests.HTTPError):
+        retrying_image_generation_request(apiKeys, "a cat", "clipdrop", None, retryPolicy=retryPolicy)
+    assert len(fake.timeouts) == retryPolicy.max_retries + 1
+
+
+def test_retry_after_is_waited_out_up_to_the_backoff_limit(monkeypatch, sleeps):
+    fake = FakeRequests(http_error(429, {"Retry-After": "0.005"}), http_error(429, {"Retry-After": "120"}))
+    monkeypatch.setattr(AIMemeGenerator, "image_generation_request", fake)
+    
+    retrying_image_generation_request(apiKeys, "a cat", "clipdrop", None, retryPolicy=retryPolicy)
+    
+    assert sleeps[0] >= 0.005
+    assert sleeps[1] == retryPolicy.backoff_max
+
+
+def test_slow_request_is_hedged(monkeypatch):
+    monkeypatch.setattr(AIMemeGenerator, "image_latency_trackers", {})
+    tracker = AIMemeGenerator.get_latency_tracker("clipdrop")
+    for _ in range(tracker.min_samples):
+        tracker.add(0.01)
+    release = threading.Event()
+    calls = []
+    
+    def fake_request(*args, **kwargs):
+        calls.append(time.perf_counter())
+        # The first request hangs until the test ends, the hedge answers straight away
+        if len(calls) == 1:
+            release.wait(5)
+            return io.BytesIO(b"slow")
+        return io.BytesIO(b"hedge")
+    
+    monkeypatch.setattr(AIMemeGenerator, "image_generation_request", fake_request)
+    try:
+        virtual_image_file = hedged_image_generation_request(apiKeys, "a cat", "clipdrop", None, retryPolicy=retryPolicy._replace(hedge=True))
+    finally:
+        release.set()
+    
+    assert virtual_image_file.read() == b"hedge"
+    assert len(calls) == 2
+
+
+def test_no_hedge_before_enough_timings(monkeypatch):
+    monkeypatch.setattr(AIMemeGenerator, "image_latency_trackers", {})
+    fake = FakeRequests()
+    monkeypatch.setattr(AIMemeGenerator, "image_generation_request", fake)
+    
+    hedged_image_generation_request(apiKeys, "a cat", "clipdrop", None, retryPolicy=retryPolicy._replace(hedge=True))
+    
+    assert len(fake.timeouts) == 1
+    assert len(AIMemeGenerator.get_latency_tracker("clipdrop").samples) == 1
@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+import AIMemeGenerator
+from tests.conftest import run_generate
+
+flask = pytest.importorskip("flask")
+
+import app as web
+
+
+def test_index_finds_sharded_memes(fake_apis):
+    fake_apis.settings.update({"Output_Sharding": "date", "Use_Meme_Index": True})
+    
+    memeInfoDict = run_generate(meme_count=1)[0]
+    
+    assert os.path.dirname(memeInfoDict["file_path"]) != os.path.abspath("Outputs")
+    store = AIMemeGenerator.get_meme_store("Outputs")
+    assert os.path.samefile(store.lookup(memeInfoDict["file_name"]), memeInfoDict["file_path"])
+    client = web.app.test_client()
+    assert client.get(f"/outputs/{memeInfoDict['file_name']}").status_code == 200
+
+
+def test_memes_are_not_sharded_without_the_index(fake_apis):
+    fake_apis.settings.update({"Output_Sharding": "date", "Use_Meme_Index": False})
+    
+    memeInfoDict = run_generate(meme_count=1)[0]
+    
+    # Nothing would record the subfolder, so the meme goes where the web app looks without the index
+    assert os.path.dirname(os.path.abspath(memeInfoDict["file_path"])) == os.path.abspath("Outputs")
+    assert not os.path.exists(os.path.join("Outputs", "index.sqlite3"))
+    client = web.app.test_client()
+    assert client.get(f"/outputs/{memeInfoDict['file_name']}").status_code == 200
+
+
+def test_only_memes_are_served_from_the_output_folder(fake_apis):
+    run_generate(meme_count=1)
+    client = web.app.test_client()
+    
+    assert os.path.isfile(os.path.join("Outputs", "index.sqlite3"))
+    for fileName in ("index.sqlite3", "log.jsonl", "..%2Fsettings.ini"):
+        assert client.get(f"/outputs/{fileName}").status_code == 404
+    assert client.get("/outputs/meme_2024-01-31-12-00_1-abcdef.png").status_code == 404
@@ -0,0 +1,16 @@
+import AIMemeGenerator
+from tests.conftest import run_generate
+
+
+def test_headless_runs_dont_print_the_metrics_table(fake_apis, capsys):
+    run_generate(meme_count=1)
+    
+    assert "Timings and counts so far" not in capsys.readouterr().out
+
+
+def test_stages_are_timed(fake_apis):
+    run_generate(meme_count=1)
+    
+    rendered = AIMemeGenerator.metrics.render_prometheus()
+    for stage in ("text", "image", "render", "total"):
+        assert f'stage="{stage}"' in rendered
@@ -0,0 +1,42 @@
+import pytest
+
+from AIMemeGenerator import parse_memes, parse_meme_reply
+
+
+def test_parse_memes_reads_every_pair():
+    message = (
+        '1. Meme Text: "When the build passes"\nImage Prompt: A programmer celebrating\n\n'
+        '2. Meme Text: Monday again\nImage Prompt: A tired cat on a keyboard\n'
+        '3) Meme Text: "Deploy on Friday"\nImage Prompt: A house on fire, photograph'
+    )
+    
+    assert parse_memes(message) == [
+        {"meme_text": "When the build passes", "image_prompt": "A programmer celebrating"},
+        {"meme_text": "Monday again", "image_prompt": "A tired cat on a keyboard"},
+        {"meme_text": "Deploy on Friday", "image_prompt": "A house on fire, photograph"},
+    ]
+
+
+def test_parse_memes_skips_text_without_pairs():
+    assert parse_memes("Sorry, I can't help with that.") == []
+
+
+def test_parse_meme_reply():
+    assert parse_meme_reply('Meme Text: "Ok"\nImage Prompt: A thumbs up') == {"meme_text": "Ok", "image_prompt": "A thumbs up"}
+    with pytest.raises(ValueError):
+        parse_meme_reply("Sorry, I can't help with that.")
+
+
+def test_parse_memes_leaves_text_between_pairs_out_of_prompts():
+    message = 'Meme 1:\nMeme Text: A\nImage Prompt: cat\n\nMeme 2:\nMeme Text: B\nImage Prompt: dog\n\nHope you like them!'
+    
+    assert parse_memes(message) == [
+        {"meme_text": "A", "image_prompt": "cat"},
+        {"meme_text": "B", "image_prompt": "dog"},
+    ]
+
+
+def test_parse_memes_strips_numbering_on_the_same_line():
+    message = 'Meme Text: A\nImage Prompt: cat 2. Meme Text: B\nImage Prompt: dog'
+    
+    assert [memeDict["image_prompt"] for memeDict in parse_memes(message)] == ["cat", "dog"]
@@ -0,0 +1,29 @@
+import pytest
+
+from AIMemeGenerator import RateLimiter
+
+
+def test_rate_limiter_queues_requests_over_the_limit(tmp_path):
+    rateLimiter = RateLimiter(str(tmp_path / "openai.bucket"), requests_per_minute=2)
+    
+    assert rateLimiter.reserve() == 0
+    assert rateLimiter.reserve() == 0
+    # The bucket is empty, so the next request waits for one to refill, and the one after that for two
+    assert rateLimiter.peek() == pytest.approx(30, abs=0.5)
+    assert rateLimiter.reserve() == pytest.approx(30, abs=0.5)
+    assert rateLimiter.reserve() == pytest.approx(60, abs=0.5)
+
+
+def test_rate_limiter_counts_tokens(tmp_path):
+    rateLimiter = RateLimiter(str(tmp_path / "openai_text.bucket"), tokens_per_minute=600)
+    
+    assert rateLimiter.reserve(tokens=600) == 0
+    assert rateLimiter.reserve(tokens=100) == pytest.approx(10, abs=0.5)
+
+
+def test_rate_limiter_is_shared_through_its_file(tmp_path):
+    path = str(tmp_path / "openai.bucket")
+    
+    RateLimiter(path, requests_per_minute=1).reserve()
+    
+    assert RateLimiter(path, requests_per_minute=1).peek() == pytest.approx(60, abs=0.5)
@@ -0,0 +1,32 @@
+import pytest
+
+import AIMemeGenerator
+from AIMemeGenerator import ApiKeysTupleClass, ImageRouterConfigTupleClass, ImageRouter
+
+
+def make_router(weights, platforms=("openai", "stability", "clipdrop")):
+    return ImageRouter(ApiKeysTupleClass("openai key", "clipdrop key", "stability key"), list(platforms), ImageRouterConfigTupleClass("weighted", weights, {}, 30))
+
+
+def test_weighted_pick_interleaves_platforms():
+    router = make_router({"openai": 2, "stability": 1, "clipdrop": 0})
+    
+    picks = [router.pick(router.providers).name for _ in range(6)]
+    
+    assert router.platforms == ["openai", "stability"]
+    assert picks == ["openai", "stability", "openai", "openai", "stability", "openai"]
+
+
+def test_weighted_pick_shares_requests_by_weight():
+    router = make_router({"openai": 3, "stability": 2, "clipdrop": 1})
+    
+    picks = [router.pick(router.providers).name for _ in range(60)]
+    
+    assert [picks.count(platform) for platform in router.platforms] == [30, 20, 10]
+    # Smooth round-robin never sends the heaviest platform more than its share in a row
+    assert "openai" * 3 not in "".join(picks)
+
+
+def test_router_without_platforms_raises():
+    with pytest.raises(AIMemeGenerator.NoImagePlatformError):
+        make_router({"openai": 0}, ["openai"])
@@ -0,0 +1,98 @@
+import io
+
+import pytest
+
+import AIMemeGenerator
+
+Image = pytest.importorskip("PIL.Image")
+ImageDraw = pytest.importorskip("PIL.ImageDraw")
+ImageFont = pytest.importorskip("PIL.ImageFont")
+
+
+texts = [
+    "When the code works on the first try",
+    "Me explaining to my cat why it can't have a third breakfast even though it clearly asked very nicely this morning",
+    "Ok",
+    "Supercalifragilisticexpialidocious antidisestablishmentarianism pneumonoultramicroscopic",
+]
+
+
+def baseline_fit(image, top_text, fontFile, buffer_size, min_scale=0.05, font_scale=1):
+    # The text fitting loop from before text_layout existed, measuring on the meme image itself
+    d = ImageDraw.Draw(image)
+    words = top_text.split()
+    font_size = int(font_scale * image.width)
+    fnt = ImageFont.truetype(fontFile, font_size)
+    wrapped_text = top_text
+    while d.textbbox((0,0), wrapped_text, font=fnt)[2] > image.width - 2 * buffer_size:
+        font_size *= 0.9
+        if font_size < min_scale * image.width:
+            lines = [words[0]]
+            for word in words[1:]:
+                new_line = (lines[-1] + ' ' + word).rstrip()
+                if d.textbbox((0,0), new_line, font=fnt)[2] > image.width - 2 * buffer_size:
+                    lines.append(word)
+                else:
+                    lines[-1] = new_line
+            wrapped_text = '\n'.join(lines)
+            break
+        fnt = ImageFont.truetype(fontFile, int(font_size))
+    return fnt, wrapped_text, font_size
+
+
+def baseline_render(image, top_text, fontFile, min_scale=0.05, buffer_scale=0.03, font_scale=1):
+    buffer_size = int(buffer_scale * image.width)
+    fnt, wrapped_text, font_size = baseline_fit(image, top_text, fontFile, buffer_size, min_scale, font_scale)
+    textbbox_val = ImageDraw.Draw(image).multiline_textbbox((0,0), wrapped_text, font=fnt)
+    band_height = textbbox_val[3] - textbbox_val[1] + int(font_size * 0.1) + 2 * buffer_size
+    band = Image.new('RGBA', (image.width, band_height), (255,255,255,255))
+    ImageDraw.Draw(band).multiline_text((band.width // 2, band.height // 2), wrapped_text, font=fnt, fill=(0,0,0,255), anchor="mm", align="center")
+    new_img = Image.new('RGBA', (image.width, image.height + band_height))
+    new_img.paste(band, (0,0))
+    new_img.paste(image, (0, band_height))
+    return new_img
+
+
+@pytest.mark.parametrize("top_text", texts)
+@pytest.mark.parametrize("width", [256, 512, 1024])
+@pytest.mark.parametrize("mode", ["RGB", "RGBA", "L"])
+def test_exact_layout_matches_baseline(top_text, width, mode, font_file):
+    image = Image.new(mode, (width, width))
+    buffer_size = int(0.03 * width)
+    
+    fnt, wrapped_text, font_size = AIMemeGenerator.fit_meme_text(top_text, font_file, width, buffer_size, ImageDraw.Draw(image).fontmode, exact=True)
+    expectedFnt, expectedText, expectedSize = baseline_fit(image, top_text, font_file, buffer_size)
+    
+    assert wrapped_text == expectedText
+    assert fnt.size == expectedFnt.size
+    assert font_size == expectedSize
+
+
+@pytest.mark.parametrize("top_text", texts)
+def test_exact_render_is_pixel_identical_to_baseline(top_text, font_file):
+    image = Image.new("RGB", (512, 384), (40, 120, 200))
+    imageFile = io.BytesIO()
+    image.save(imageFile, format="PNG")
+    imageFile.seek(0)
+    
+    virtualMemeFile, renderTimings = AIMemeGenerator.render_meme_file(imageFile, top_text, None, font_file, noFileSave=True)
+    
+    rendered = Image.open(virtualMemeFile)
+    expected = baseline_render(image, top_text, font_file)
+    assert rendered.size == expected.size
+    assert rendered.convert("RGB").tobytes() == expected.convert("RGB").tobytes()
+
+
+@pytest.mark.parametrize("top_text", texts)
+def test_fast_layout_fits(top_text, font_file):
+    width = 512
+    buffer_size = int(0.03 * width)
+    
+    fnt, wrapped_text, font_size = AIMemeGenerator.fit_meme_text(top_text, font_file, width, buffer_size, exact=False)
+    
+    assert fnt.size == font_size
+    if "\n" not in wrapped_text:
+        assert AIMemeGenerator.measure_text_width(font_file, font_size, wrapped_text) <= width - 2 * buffer_size
+        # The largest size that fits, so one size up doesn't
+        if font_size < width:
+            assert AIMemeGenerator.measure_text_width(font_file, font_size + 1, wrapped_text) > width - 2 * buffer_size